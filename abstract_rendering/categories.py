@@ -10,6 +10,8 @@ import numpy as np
 from math import log
 import abstract_rendering.util as util
 import abstract_rendering.core as core
+import abstract_rendering.geometry as geometry
+from abstract_rendering.glyphset import ShapeCodes
 
 
 # ------------ Aggregators -------------------
@@ -23,29 +25,53 @@ class CountCategories(core.GlyphAggregator):
     any call to combine must in some way correspond to the most recent
     call to allocate.
 
+    Passing the list of categories at construction fixes the category
+    planes instead.  This is required to rollup aggregates made from
+    different glyphsets (e.g., when rendering in chunks).
+
     TODO: This seems convoluted...is there a better way?
     """
     out_type = np.int32
     identity = np.asarray([0])
     cats = None
+    batch_codes = (ShapeCodes.POINT, ShapeCodes.RECT, ShapeCodes.LINE)
+
+    def __init__(self, cats=None):
+        self.fixed_cats = None if cats is None else np.unique(cats)
 
     def allocate(self, glyphset, screen):
-        """Allocates one array slice for each unique info passed.
+        """Allocates one array slice for each unique info passed
+           (or for each category given at construction).
            Output array shape is (#cats, height, width).
 
         """
         (width, height) = screen
-        self.cats = np.unique(glyphset.data())
+        if self.fixed_cats is not None:
+            self.cats = self.fixed_cats
+        else:
+            self.cats = np.unique(glyphset.data())
         return np.zeros((height, width, len(self.cats)), dtype=self.out_type)
 
     def combine(self, existing, points, shapecode, val):
-        entry = np.zeros(len(self.cats))
+        entry = np.zeros(len(self.cats), dtype=self.out_type)
         idx = np.nonzero(self.cats == val)[0][0]
         entry[idx] = 1
         update = self.glyphAggregates(points, shapecode, entry, self.identity)
         existing[points[1]:points[3], points[0]:points[2], :] \
                 += update
 
+    def combineAll(self, existing, glyphs, shapecode, vals):
+        depth = len(self.cats)
+        (height, width, _) = existing.shape
+        codes = np.searchsorted(self.cats, vals)
+        known = codes < depth
+        known[known] = (self.cats[codes[known]] == vals[known])
+        (glyphs, codes) = (glyphs[known], codes[known])
+
+        batches = ((g, p*depth + codes[g]) for (g, p)
+                   in geometry.pixels(glyphs, shapecode, (width, height)))
+        core.scatter_add_batches(existing, batches)
+
     def rollup(self, *vals):
         """NOTE: Assumes co-registration of categories..."""
         return reduce(lambda x, y: x+y,  vals)
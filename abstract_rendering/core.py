@@ -4,13 +4,18 @@ execution and the base clases for shared data representations.
 from __future__ import print_function, division, absolute_import
 from six.moves import range
 
+import os
+import inspect
 import numpy as np
 import abstract_rendering.geometry as geometry
 import abstract_rendering.glyphset as glyphset
+import abstract_rendering.infos as infos
+import abstract_rendering.fast_aggregate as fast_aggregate
 
 
 # ------------------- Basic process function --------------------------------
-def render(glyphs, info, aggregator, shader, screen, vt):
+def render(glyphs, info, aggregator, shader, screen, vt,
+           workers=None, tile=None, backend="threads", context=None):
     """
     Render a set of glyphs to the described canvas.
 
@@ -20,27 +25,544 @@ def render(glyphs, info, aggregator, shader, screen, vt):
     * shader -- Converts aggregates to other aggregates (often colors)
     * screen -- (width,height) of the canvas
     * vt -- View transform (converts canvas to pixels)
+    * workers -- Number of threads to aggregate with (see aggregate_parallel).
+                 Default (None) aggregates on the calling thread.
+    * tile -- (width, height) of screen tiles to aggregate separately
+              (see aggregate_tiled).  Default (None) does not tile.
+    * backend -- How workers run partitions: "threads" (aggregate_parallel,
+                 the default) or "processes" (aggregate_processes)
+    * context -- RenderContext whose buffers are reused (default is None)
     """
-    projected = glyphs.project(vt)
-    aggregates = aggregator.aggregate(projected, info, screen)
+    if backend not in ("threads", "processes"):
+        raise ValueError("Unknown backend '%s'" % backend)
+    if tile is not None and backend != "threads":
+        raise ValueError("Tiled rendering only supports the threads backend")
+
+    if context is None:
+        projected = glyphs.project(vt, screen)
+    else:
+        projected = context.project(glyphs, vt, screen)
+
+    if tile is not None:
+        aggregates = aggregate_tiled(projected, info, aggregator,
+                                     screen, tile, workers)
+    elif (workers is None or workers <= 1) and context is not None:
+        aggregates = context.aggregate(projected, info, aggregator, screen)
+    elif workers is None or workers <= 1:
+        aggregates = aggregator.aggregate(projected, info, screen)
+    elif backend == "processes":
+        aggregates = aggregate_processes(projected, info, aggregator,
+                                         screen, workers)
+    else:
+        aggregates = aggregate_parallel(projected, info, aggregator,
+                                        screen, workers)
     # TODO: Add shader specialization here
+    if context is not None:
+        context.record(glyphs, info, aggregator, screen, vt, aggregates)
+        return context.shade(shader, aggregates)
     rslt = shader(aggregates)
     return rslt
 
 
+def render_pan(glyphs, info, aggregator, shader, screen, vt, context):
+    """
+    Render, updating the previous frame of the context for a pan.
+
+    If the last render with this context used the same glyphs, info,
+    aggregator and screen, and vt only translates its view by whole
+    pixels (less than a screen), the previous aggregates are shifted in
+    place.  Then only the newly exposed strips (plus the edge row/column
+    where pixel rounding differs) are aggregated, and the result is
+    re-shaded.  Anything else (and any pan of LINE glyphs) is a full
+    render with the context.
+
+    Aggregators must produce cells that only depend on the glyphs
+    touching them, co-registered across parts of the screen (see
+    aggregate_tiled).  Without a spatial index (Glyphset.buildIndex),
+    glyphs are still projected in full, so the savings are in
+    aggregation only; with one, work is proportional to the glyphs
+    in the strips.
+
+    * glyphs, info, aggregator, shader, screen, vt -- As for render
+    * context -- RenderContext holding the previous frame
+    """
+    shift = context.panShift(glyphs, info, aggregator, screen, vt)
+    if shift is None:
+        return render(glyphs, info, aggregator, shader, screen, vt,
+                      context=context)
+
+    aggregates = context.aggregates
+    _shift_grid(aggregates, shift)
+    regions = _pan_regions(screen, shift)
+
+    if glyphs.spatial is None:
+        projected = glyphs.project(vt, screen)
+        sources = [projected] * len(regions)
+    else:
+        sources = [glyphs.near(vt, r).project(vt) for r in regions]
+
+    for (source, region) in zip(sources, regions):
+        (x0, y0, x1, y1) = region
+        part = np.asarray(aggregate_region(source, info, aggregator, region))
+        target = aggregates[y0:y1, x0:x1]
+        if part.shape == target.shape:
+            target[...] = part
+        elif (part.ndim == target.ndim and
+              all(p <= t for (p, t) in zip(part.shape, target.shape))):
+            target[...] = 0
+            target[tuple(slice(0, d) for d in part.shape)] = part
+        else:
+            # More category planes than the previous frame: start over
+            context.forget()
+            return render(glyphs, info, aggregator, shader, screen, vt,
+                          context=context)
+
+    context.record(glyphs, info, aggregator, screen, vt, aggregates)
+    return context.shade(shader, aggregates)
+
+
+_IDENTITY = (0, 0, 1, 1)
+
+
+def _shift_grid(grid, shift):
+    """Move the contents of a grid by (dx, dy) cells, in place.
+       Vacated cells keep stale values."""
+    (dx, dy) = shift
+    (height, width) = grid.shape[:2]
+    source = grid[max(0, -dy):height-max(0, dy), max(0, -dx):width-max(0, dx)]
+    grid[max(0, dy):height-max(0, -dy), max(0, dx):width-max(0, -dx)] = source
+
+
+def _pan_regions(screen, shift):
+    """Pixel regions to re-aggregate after shifting a grid by (dx, dy).
+
+    Besides the exposed strip, the first column is redone (it collects
+    glyphs that project into (-1, 0), which truncate to 0), and so is
+    the column the old first column moved to.  Likewise for rows.
+    """
+    (width, height) = screen
+    (dx, dy) = shift
+    regions = []
+    if dx > 0:
+        regions.append((0, 0, min(dx+1, width), height))
+    elif dx < 0:
+        regions.extend([(width+dx, 0, width, height), (0, 0, 1, height)])
+    if dy > 0:
+        regions.append((0, 0, width, min(dy+1, height)))
+    elif dy < 0:
+        regions.extend([(0, height+dy, width, height), (0, 0, width, 1)])
+    return regions
+
+
+class RenderContext(object):
+    """
+    Buffers that render reuses from one call to the next, such as the
+    frames of an interactive pan/zoom.
+
+    Holds the projection output, the aggregates grid and the output of
+    each cell shader stage.  A buffer is reused when the next frame needs
+    one of the same shape and type (same glyph count and screen size),
+    and replaced otherwise.  Reuse saves the allocation and page faults
+    of fresh buffers.
+
+    Results of a render with a context are overwritten by the next render
+    with that context; copy them to keep them.  Use one context per
+    sequence of frames (and per thread).
+    """
+    def __init__(self):
+        self._projection = None
+        self.aggregates = None
+        self.shaded = {}
+        self.frame = None
+
+    def record(self, glyphs, info, aggregator, screen, vt, aggregates):
+        "Remember what the last frame rendered (see render_pan)."
+        self.aggregates = aggregates
+        self.frame = (glyphs, info, aggregator, tuple(screen), tuple(vt))
+
+    def forget(self):
+        "Drop the last frame, so the next render_pan renders in full."
+        self.frame = None
+
+    def panShift(self, glyphs, info, aggregator, screen, vt):
+        """The whole-pixel (dx, dy) that takes the last frame to this
+           one, or None if it is not such a pan."""
+        if self.frame is None or not isinstance(self.aggregates, np.ndarray):
+            return None
+        (last_glyphs, last_info, last_aggregator, last_screen, last_vt) = self.frame
+        if (last_glyphs is not glyphs or last_info is not info
+                or last_aggregator is not aggregator
+                or last_screen != tuple(screen)
+                or last_vt[2:] != tuple(vt[2:])
+                or tuple(self.aggregates.shape[:2]) != tuple(screen[::-1])):
+            return None
+
+        if _IDENTITY in (last_vt, tuple(vt)):
+            # Some glyphsets skip projection (and its rounding) for it
+            return None
+        if getattr(glyphs.shaper, "code", None) == glyphset.ShapeCodes.LINE:
+            # Projection truncates toward zero, so a pan moves endpoints
+            # left of (or above) the screen by a different whole pixel,
+            # and their lines take a different path everywhere.
+            return None
+
+        shift = (vt[0] - last_vt[0], vt[1] - last_vt[1])
+        if any(d != int(d) for d in shift):
+            return None
+        (dx, dy) = (int(shift[0]), int(shift[1]))
+        if abs(dx) >= screen[0] or abs(dy) >= screen[1]:
+            return None
+        return (dx, dy)
+
+    @property
+    def projected(self):
+        """The projection buffer to reuse.  Read from the last projection
+           when needed, as glyphsets may project lazily."""
+        if self._projection is None:
+            return None
+        return self._projection.buffer
+
+    def project(self, glyphs, vt, screen):
+        "Project the glyphs, reusing the projection buffer."
+        buffer = self.projected
+        if buffer is None:
+            projected = glyphs.project(vt, screen)
+        else:
+            projected = glyphs.project(vt, screen, out=buffer)
+        self._projection = projected
+        return projected
+
+    def aggregate(self, glyphs, info, aggregator, screen):
+        """Aggregate (already projected) glyphs, reusing the aggregates
+           grid if the aggregator takes one (see Aggregator.aggregate)."""
+        if _takes_out(aggregator.aggregate):
+            aggregates = aggregator.aggregate(glyphs, info, screen,
+                                              out=self.aggregates)
+        else:
+            aggregates = aggregator.aggregate(glyphs, info, screen)
+        self.aggregates = aggregates
+        return aggregates
+
+    def shade(self, shader, grid):
+        """Run each stage of the shader, giving cell shaders the buffer
+           their stage produced last time."""
+        parts = shader._parts if isinstance(shader, Seq) else (shader,)
+        for (stage, part) in enumerate(parts):
+            if isinstance(part, CellShader):
+                result = part(grid, out=self.shaded.get(stage))
+                if (isinstance(result, np.ndarray)
+                        and not np.may_share_memory(result, grid)):
+                    self.shaded[stage] = result
+                else:
+                    self.shaded.pop(stage, None)
+            else:
+                result = part(grid)
+            grid = result
+        return grid
+
+
+def _takes_out(function):
+    "Can the function be passed an out keyword argument?"
+    try:
+        signature = inspect.signature(function)
+    except AttributeError:
+        # Python 2
+        try:
+            spec = inspect.getargspec(function)
+        except TypeError:
+            return False
+        return "out" in spec.args or spec.keywords is not None
+    except (TypeError, ValueError):
+        return False
+    return any(p.name == "out" or p.kind == p.VAR_KEYWORD
+               for p in signature.parameters.values())
+
+
+def aggregate_parallel(glyphs, info, aggregator, screen, workers):
+    """
+    Aggregate with a pool of threads.
+
+    The (projected) glyphs are split into 'workers' contiguous partitions.
+    Each partition is aggregated in its own thread into a private grid and
+    the private grids are merged with aggregator.rollup.  Speedup depends
+    on the aggregator releasing the GIL; the vectorized paths of Count, Sum
+    and CountCategories do (native kernels plus large numpy operations).
+
+    The aggregator instance is shared by all threads, so it must produce
+    co-registered results without per-call state (e.g., give
+    CountCategories an explicit category list).
+
+    * glyphs -- Projected glyphs to aggregate
+    * info, aggregator, screen -- As for render
+    * workers -- Number of partitions (and threads)
+    """
+    from multiprocessing.pool import ThreadPool
+
+    parts = glyphs.partition(workers)
+    pool = ThreadPool(len(parts))
+    try:
+        partials = pool.map(lambda part: aggregator.aggregate(part, info, screen),
+                            parts)
+    finally:
+        pool.close()
+    return aggregator.rollup(*partials)
+
+
+def _shared_dir():
+    "Directory for memory-mapped transfer files, in RAM when possible."
+    import tempfile
+    shm = "/dev/shm"
+    return tempfile.mkdtemp(prefix="ar-",
+                            dir=shm if os.path.isdir(shm) else None)
+
+
+def _aggregate_partition(path, start, stop, data, shapecode,
+                         info, aggregator, screen, out):
+    """Process body for aggregate_processes.
+       Data is either this partition's data or None (load it from path)."""
+    points = np.load(os.path.join(path, "points.npy"), mmap_mode="r")
+    if data is None and os.path.exists(os.path.join(path, "data.npy")):
+        data = np.load(os.path.join(path, "data.npy"), mmap_mode="r")
+        data = data[start:stop]
+    part = glyphset.Glyphset(points[start:stop], data,
+                             glyphset.Literals(shapecode))
+    aggregates = np.asarray(aggregator.aggregate(part, info, screen))
+    result = np.lib.format.open_memmap(out, mode="w+",
+                                       dtype=aggregates.dtype,
+                                       shape=aggregates.shape)
+    result[...] = aggregates
+    result.flush()
+
+
+def aggregate_processes(glyphs, info, aggregator, screen, workers):
+    """
+    Aggregate with a set of worker processes.
+
+    For aggregators that hold the GIL (e.g., pure python combine),
+    where threads do not help.  The glyph points (and numeric data) are
+    written once to memory-mapped files (in /dev/shm when available) that
+    every worker maps, instead of being pickled.  Each worker aggregates a
+    contiguous partition and writes its grid to a memory-mapped file;
+    the parent maps those and merges them with aggregator.rollup.
+
+    Workers are forked, so info and aggregator (and non-numeric data)
+    are inherited rather than pickled; platforms without fork need them
+    to be picklable.  The co-registration caveats of aggregate_parallel
+    apply here too.
+
+    * glyphs -- Projected glyphs to aggregate
+    * info, aggregator, screen -- As for render
+    * workers -- Number of partitions (and processes)
+    """
+    import multiprocessing
+    import shutil
+
+    context = multiprocessing
+    if hasattr(multiprocessing, "get_context"):
+        methods = multiprocessing.get_all_start_methods()
+        if "fork" in methods:
+            context = multiprocessing.get_context("fork")
+
+    points = np.asarray(glyphs.points())
+    data = glyphs.data()
+    path = _shared_dir()
+    try:
+        shared = np.lib.format.open_memmap(os.path.join(path, "points.npy"),
+                                           mode="w+", dtype=points.dtype,
+                                           shape=points.shape)
+        shared[...] = points
+        shared.flush()
+        del shared
+
+        if isinstance(data, np.ndarray) and data.dtype != object:
+            np.save(os.path.join(path, "data.npy"), data)
+            data = None
+
+        bounds = np.linspace(0, len(points), workers+1).astype(int)
+        outs = [os.path.join(path, "part-%d.npy" % i) for i in range(workers)]
+        procs = [context.Process(target=_aggregate_partition,
+                                 args=(path, start, stop,
+                                       glyphset.take(data, np.arange(start, stop)),
+                                       glyphs.shaper.code,
+                                       info, aggregator, screen, out))
+                 for (start, stop, out) in zip(bounds[:-1], bounds[1:], outs)]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+
+        failed = [p.exitcode for p in procs if p.exitcode != 0]
+        if failed:
+            raise RuntimeError("Aggregation worker failed (exit codes %s)"
+                               % failed)
+
+        partials = [np.load(out, mmap_mode="r") for out in outs]
+        return np.array(aggregator.rollup(*partials))
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def _glyph_bounds(points, shapecode):
+    """Pixel bounds (lo, hi) of projected glyphs, as (x, y) column pairs
+       with hi exclusive."""
+    if shapecode == glyphset.ShapeCodes.LINE:
+        # Endpoints are inclusive and may come in either order
+        lo = np.minimum(points[:, 0:2], points[:, 2:4])
+        hi = np.maximum(points[:, 0:2], points[:, 2:4]) + 1
+    elif shapecode == glyphset.ShapeCodes.POINT:
+        # Points fall in the pixel of their (floored) corner.  Their far
+        # corner may be unprojected (e.g., zero width and height from
+        # a glyphset that skips the identity transform).
+        lo = np.floor(points[:, 0:2]).astype(np.intp)
+        hi = lo + 1
+    else:
+        (lo, hi) = (points[:, 0:2], points[:, 2:4])
+    return (lo, hi)
+
+
+def _aggregate_window(points, data, idxs, shapecode, origin, sub_screen,
+                      info, aggregator):
+    """Aggregate the selected (projected) glyphs into a grid covering
+       sub_screen pixels from origin.  Glyphs are moved to window
+       coordinates and, except lines, clipped to the window."""
+    (ox, oy) = origin
+    sub = points[idxs] - [ox, oy, ox, oy]
+    if shapecode != glyphset.ShapeCodes.LINE:
+        sub = np.clip(sub, 0, tuple(sub_screen) * 2)
+    part = glyphset.Glyphset(sub, glyphset.take(data, idxs),
+                             glyphset.Literals(shapecode))
+    return aggregator.aggregate(part, info, sub_screen)
+
+
+def aggregate_region(glyphs, info, aggregator, region):
+    """
+    Aggregate just one rectangle of the screen.
+
+    Gives the same values as that part of a full-screen aggregate for
+    aggregators whose cells only depend on the glyphs touching them
+    (with the co-registration caveats of aggregate_tiled).
+
+    * glyphs -- Projected glyphs
+    * info, aggregator -- As for render
+    * region -- Pixel rectangle (x0, y0, x1, y1), x1/y1 exclusive
+    """
+    (x0, y0, x1, y1) = region
+    shapecode = glyphs.shaper.code
+    points = np.asarray(glyphs.points())
+    (lo, hi) = _glyph_bounds(points, shapecode)
+    idxs = np.flatnonzero((hi[:, 0] > x0) & (lo[:, 0] < x1) &
+                          (hi[:, 1] > y0) & (lo[:, 1] < y1))
+    return _aggregate_window(points, glyphs.data(), idxs, shapecode,
+                             (x0, y0), (x1-x0, y1-y0), info, aggregator)
+
+
+def aggregate_tiled(glyphs, info, aggregator, screen, tile, workers=None):
+    """
+    Aggregate the screen one tile at a time.
+
+    Glyphs are bucketed by the tiles their bounding boxes touch (one pass
+    over all glyphs).  Each tile is then aggregated on its own, in tile
+    coordinates, into a tile-sized grid that is copied into its place in
+    the output.  Tiles do not overlap, so no rollup is needed and no worker
+    ever holds a full-screen grid.
+
+    Output planes beyond the first two dimensions (e.g., categories) are
+    assumed to be index-aligned across tiles; tiles with fewer planes are
+    zero-filled in the missing ones.  As with aggregate_parallel,
+    CountCategories needs an explicit category list.
+
+    * glyphs -- Projected glyphs to aggregate
+    * info, aggregator, screen -- As for render
+    * tile -- (width, height) of each tile
+    * workers -- Number of threads to process tiles with (default one)
+    """
+    (width, height) = screen
+    (tw, th) = tile
+    (ntx, nty) = (-(-width // tw), -(-height // th))
+    shapecode = glyphs.shaper.code
+    points = np.asarray(glyphs.points())
+    data = glyphs.data()
+
+    (lo, hi) = _glyph_bounds(points, shapecode)
+    coarse = np.hstack([lo // tile, -(-hi // tile)])
+    (members, tiles) = geometry.rect_pixels(coarse, (ntx, nty))
+    order = np.argsort(tiles, kind="mergesort")
+    (members, tiles) = (members[order], tiles[order])
+    splits = np.searchsorted(tiles, np.arange(ntx*nty + 1))
+
+    def aggregate_tile(t):
+        (ox, oy) = ((t % ntx) * tw, (t // ntx) * th)
+        sub_screen = (min(tw, width - ox), min(th, height - oy))
+        idxs = members[splits[t]:splits[t+1]]
+        return _aggregate_window(points, data, idxs, shapecode,
+                                 (ox, oy), sub_screen, info, aggregator)
+
+    if workers is None or workers <= 1:
+        parts = [aggregate_tile(t) for t in range(ntx*nty)]
+    else:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(workers)
+        try:
+            parts = pool.map(aggregate_tile, range(ntx*nty))
+        finally:
+            pool.close()
+
+    planes = tuple(np.max([p.shape[2:] for p in parts], axis=0).astype(int))
+    out = np.zeros((height, width) + planes,
+                   dtype=np.result_type(*[p.dtype for p in parts]))
+    for (t, part) in enumerate(parts):
+        (ox, oy) = ((t % ntx) * tw, (t // ntx) * th)
+        target = out[oy:oy+part.shape[0], ox:ox+part.shape[1]]
+        target[(Ellipsis,) + tuple(slice(0, d) for d in part.shape[2:])] = part
+    return out
+
+
+def render_stream(chunks, info, aggregator, shader, screen, vt):
+    """
+    Render glyphs that arrive as a sequence of smaller glyphsets.
+
+    Each chunk is projected and aggregated on its own, then merged into
+    the running aggregates with aggregator.rollup.  Only one chunk is
+    held at a time, so peak memory depends on the chunk size (plus a few
+    aggregate grids), not on the size of the whole dataset.
+
+    Aggregators must produce co-registered aggregates for every chunk
+    (e.g., give CountCategories an explicit category list).
+
+    * chunks -- Iterable of glyphsets (may be a generator)
+    * info, aggregator, shader, screen, vt -- As for render
+    """
+    aggregates = None
+    for glyphs in chunks:
+        projected = glyphs.project(vt, screen)
+        partial = aggregator.aggregate(projected, info, screen)
+        if aggregates is None:
+            aggregates = partial
+        else:
+            aggregates = aggregator.rollup(aggregates, partial)
+
+    if aggregates is None:
+        raise ValueError("No glyph chunks to render.")
+    return shader(aggregates)
+
+
 # -------------------------  Aggregators and related utilities ----------------
 class Aggregator(object):
     out_type = None
     in_type = None
     identity = None
 
-    def aggregate(self, glyphset, info, screen):
+    def aggregate(self, glyphset, info, screen, out=None):
         """
         Produce a set of aggregates
 
         glyphset -- glyphs to process
         screen -- (width, height) of the output grid
         info -- info function to invoke
+        out -- Aggregates returned by an earlier call, to be reused if
+               they fit (their contents are discarded).  May be ignored,
+               or left out of the signature (RenderContext then does
+               not pass it).
         """
 
         raise NotImplementedError()
@@ -76,7 +598,13 @@ class GlyphAggregator(Aggregator):
           required
 
     Sub-classes need to implement allocate and combine.
+
+    Sub-classes that can process all glyphs in one vectorized pass
+    also implement 'combineAll' and list the shapecodes it handles in
+    'batch_codes'.  Glyphsets with any other shapecode fall back to
+    calling 'combine' once per glyph.
     """
+    batch_codes = ()
 
     def allocate(self, glyphset, screen):
         """
@@ -88,6 +616,22 @@ class GlyphAggregator(Aggregator):
         """
         raise NotImplementedError()
 
+    def reallocate(self, existing, glyphset, screen):
+        """
+        Reset aggregates from an earlier allocate for reuse, or return
+        None if they cannot be used for this glyphset and screen.
+
+        The default reuses (height, width) grids of out_type, filled with
+        the identity.  Sub-classes with other layouts override it.
+        """
+        (width, height) = screen
+        if (self.identity is None or self.out_type is None
+                or existing.shape != (height, width)
+                or existing.dtype != self.out_type):
+            return None
+        existing.fill(self.identity)
+        return existing
+
     def combine(self, existing, points, shapecode, val):
         """Add a new point to an existing set of aggregates.
 
@@ -98,20 +642,38 @@ class GlyphAggregator(Aggregator):
         """
         raise NotImplementedError()
 
-    def aggregate(self, glyphset, info, screen):
-        # TODO: vectorize pretty much this whole method...
-        (width, height) = screen
+    def combineAll(self, existing, glyphs, shapecode, vals):
+        """Add all glyphs to an existing set of aggregates at once.
+
+        * existing - out_type numpy array, aggregate values for all glyphs seen
+        * glyphs - array of projected glyphs, one per row
+        * shapecode - Code that determines how glyphs are interpreted
+                      (always one of 'batch_codes')
+        * vals -- Array of info values, vals[n] is associated with glyphs[n]
+        """
+        raise NotImplementedError()
+
+    def aggregate(self, glyphset, info, screen, out=None):
+        points = glyphset.points()
+        shapecode = glyphset.shaper.code
 
-        # co-iterating on number of points in case glyphset.data() is a non-length-carrying placeholder
-        # TODO: Should the default placeholder carry length?
-        infos = [info(data) for (data, _)
-                 in zip(glyphset.data(), range(len(glyphset.points())))]
-        aggregates = self.allocate(glyphset, screen)
-        for idx, points in enumerate(glyphset.points()):
+        vals = infos.evaluate(info, glyphset.data(), len(points))
+        aggregates = None
+        if out is not None:
+            aggregates = self.reallocate(out, glyphset, screen)
+        if aggregates is None:
+            aggregates = self.allocate(glyphset, screen)
+
+        if shapecode in self.batch_codes:
+            self.combineAll(aggregates, np.asarray(points),
+                            shapecode, np.asarray(vals))
+            return aggregates
+
+        for idx, glyph in enumerate(points):
             self.combine(aggregates,
-                         points,
-                         glyphset.shaper.code,
-                         infos[idx])
+                         glyph,
+                         shapecode,
+                         vals[idx])
         return aggregates
 
     def glyphAggregates(self, glyph, shapeCode, val, default):
@@ -155,6 +717,158 @@ class GlyphAggregator(Aggregator):
         return array
 
 
+class UfuncAggregator(GlyphAggregator):
+    """
+    Aggregator defined by a binary numpy ufunc: each cell is the
+    reduction (with the ufunc) of the info values of the glyphs that
+    touch it, starting from the identity.  For example, np.maximum with
+    identity -inf is the largest value in each cell.
+
+    Aggregation is a vectorized scatter-reduce (see scatter_reduce) for
+    points, rects and lines; rollup reduces the parts into a new grid.
+    The ufunc should be associative and commutative, so parts can be
+    reduced in any order.
+
+    Sub-classes may set ufunc, identity and out_type as class
+    attributes instead of passing them.
+
+    * ufunc -- Binary ufunc (np.add, np.maximum, np.bitwise_or...)
+    * identity -- Value of cells that no glyph touches
+    * out_type -- dtype of the aggregates; info values are converted to it
+    """
+    ufunc = None
+    batch_codes = (glyphset.ShapeCodes.POINT, glyphset.ShapeCodes.RECT,
+                   glyphset.ShapeCodes.LINE)
+
+    def __init__(self, ufunc=None, identity=None, out_type=None):
+        if ufunc is not None:
+            self.ufunc = ufunc
+        if identity is not None:
+            self.identity = identity
+        if out_type is not None:
+            self.out_type = out_type
+        if self.ufunc is None or self.identity is None or self.out_type is None:
+            raise ValueError("UfuncAggregator needs a ufunc, an identity "
+                             "and an out_type")
+
+    def allocate(self, glyphset, screen):
+        (width, height) = screen
+        return np.full((height, width), self.identity, dtype=self.out_type)
+
+    def combine(self, existing, glyph, shapecode, val):
+        update = self.glyphAggregates(glyph, shapecode, val, self.identity)
+        region = existing[glyph[1]:glyph[3], glyph[0]:glyph[2]]
+        self.ufunc(region, update.astype(region.dtype), out=region)
+
+    def combineAll(self, existing, glyphs, shapecode, vals):
+        (height, width) = existing.shape
+        vals = np.asarray(vals, dtype=existing.dtype)
+        scatter_reduce_batches(existing, self.ufunc,
+                               geometry.pixels(glyphs, shapecode,
+                                               (width, height)),
+                               vals)
+
+    def rollup(self, *vals):
+        """Reduce the parts into a new grid (the parts may be read-only)."""
+        total = np.array(vals[0])
+        for v in vals[1:]:
+            self.ufunc(total, v, out=total)
+        return total
+
+
+def ufunc_into(ufunc, out, grid, *args):
+    """
+    Apply a ufunc to grid (and args), writing into out when it has the
+    shape and dtype of the result.  For CellShader.shadeInto.
+
+    * ufunc -- The numpy ufunc to apply
+    * out -- Candidate output grid (may be None)
+    * grid -- Input grid
+    * args -- Other (scalar) ufunc arguments
+    """
+    if out is not None and out.shape == grid.shape:
+        # Apply to an empty slice to find the result type cheaply
+        dtype = ufunc(grid[:0], *args).dtype
+        if out.dtype == dtype:
+            return ufunc(grid, *args, out=out)
+    return ufunc(grid, *args)
+
+
+def scatter_add(existing, pixels, weights=None):
+    """Add into an aggregates grid at many (possibly repeated) positions.
+
+    * existing -- Grid to update in place
+    * pixels -- Indices into the raveled grid
+    * weights -- Amount to add at each index (default is one per index)
+
+    Uses the native kernels in fast_aggregate when they support the grid
+    (those run without holding the GIL), numpy's bincount otherwise.
+    """
+    if fast_aggregate.scatter_add(existing, pixels, weights):
+        return
+    counts = np.bincount(pixels, weights=weights, minlength=existing.size)
+    existing += counts.reshape(existing.shape).astype(existing.dtype)
+
+
+def scatter_reduce(existing, ufunc, pixels, vals):
+    """Reduce values into an aggregates grid at many (possibly repeated)
+    positions: existing[p] = ufunc(existing[p], v) for each pair.
+
+    * existing -- C-contiguous grid to update in place
+    * ufunc -- Binary numpy ufunc (np.add, np.maximum, np.bitwise_or...)
+    * pixels -- Indices into the raveled grid
+    * vals -- Value for each index
+
+    np.add goes through scatter_add, others through ufunc.at.
+    """
+    if ufunc is np.add:
+        scatter_add(existing, pixels, vals)
+    else:
+        ufunc.at(existing.reshape(-1), pixels, vals)
+
+
+def _pool_batches(batches, size):
+    """Concatenate a stream of (glyphs, pixels) batches into batches of
+       at least size pixels (except the last)."""
+    pending = []
+    count = 0
+    for batch in batches:
+        pending.append(batch)
+        count += len(batch[1])
+        if count >= size:
+            yield (np.concatenate([g for (g, _) in pending]),
+                   np.concatenate([p for (_, p) in pending]))
+            pending = []
+            count = 0
+    if pending:
+        yield (np.concatenate([g for (g, _) in pending]),
+               np.concatenate([p for (_, p) in pending]))
+
+
+def scatter_add_batches(existing, batches, weights=None):
+    """Scatter_add a stream of (glyphs, pixels) batches (see geometry.pixels).
+
+    Small batches are pooled until they hold at least a grid's worth of
+    pixels, so each pass over the grid does a proportional amount of work.
+
+    * existing -- Grid to update in place
+    * batches -- Iterable of (glyphs, pixels) index arrays
+    * weights -- Per-glyph amount to add (default is one per pixel)
+    """
+    for (glyphs, pixels) in _pool_batches(batches, existing.size):
+        if weights is None:
+            scatter_add(existing, pixels)
+        else:
+            scatter_add(existing, pixels, weights[glyphs])
+
+
+def scatter_reduce_batches(existing, ufunc, batches, vals):
+    """Scatter_reduce a stream of (glyphs, pixels) batches, pooled as in
+       scatter_add_batches.  vals holds one value per glyph."""
+    for (glyphs, pixels) in _pool_batches(batches, existing.size):
+        scatter_reduce(existing, ufunc, pixels, vals[glyphs])
+
+
 # ---------------------- Shaders and related utilities --------------------
 class Shader(object):
     """Shaders take grids and analize them.
@@ -189,10 +903,25 @@ class CellShader(Shader):
         """Execute the actual data shader operation."""
         raise NotImplementedError
 
-    def __call__(self, grid):
-        """Execute shading (by default)."""
+    def shadeInto(self, grid, out):
+        """
+        Shade, writing the result into out if possible.
+
+        out is a grid this shader returned earlier.  The default ignores
+        it; shaders that can write in place override this.
+        Returns the result (out when it was used).
+        """
         return self.shade(grid)
 
+    def __call__(self, grid, out=None):
+        """Execute shading (by default).
+
+           out -- Grid to reuse for the result (see shadeInto)
+        """
+        if out is None:
+            return self.shade(grid)
+        return self.shadeInto(grid, out)
+
 
 class Seq(Shader):
     "Shader that does a sequence of shaders."
@@ -0,0 +1,146 @@
+"""
+Native accumulation kernels, used by aggregators when available.
+
+The kernels are loaded through ctypes, which releases the GIL while
+they run.  If the library was not built, the functions here report
+that they did nothing (by returning False) and callers use numpy instead.
+"""
+from __future__ import print_function
+import ctypes
+import numpy as np
+import os
+
+from abstract_rendering.fast_project import so_ext
+
+
+def _type_lib(lib):
+    from ctypes import c_void_p, c_size_t, c_ssize_t
+
+    for suffix in _suffixes.values():
+        getattr(lib, "scatter_count_" + suffix).argtypes = \
+            [c_void_p, c_size_t, c_void_p, c_size_t]
+        getattr(lib, "scatter_add_" + suffix).argtypes = \
+            [c_void_p, c_void_p, c_size_t, c_void_p, c_size_t]
+        for in_suffix in _coordinate_suffixes.values():
+            getattr(lib, "project_scatter_%s_%s" % (in_suffix, suffix)).argtypes = \
+                [c_void_p, c_ssize_t, c_void_p, c_ssize_t, c_void_p,
+                 c_size_t, c_void_p, c_void_p, c_size_t, c_size_t]
+    lib.scatter_moments_f8.argtypes = \
+        [c_void_p, c_void_p, c_size_t, c_void_p, c_size_t]
+
+_suffixes = {np.dtype(np.int32): "i4",
+             np.dtype(np.int64): "i8",
+             np.dtype(np.float32): "f4",
+             np.dtype(np.float64): "f8"}
+
+_coordinate_suffixes = {np.dtype(np.float32): "f4",
+                        np.dtype(np.float64): "f8"}
+
+try:
+    _lib_filename = "accumulate{0}".format(so_ext)
+    _lib = ctypes.CDLL(os.path.join(os.path.dirname(__file__), _lib_filename))
+    _type_lib(_lib)
+except OSError:
+    _lib = None
+
+
+def available(grid):
+    "Can the native kernels accumulate into this grid?"
+    return (_lib is not None
+            and grid.dtype in _suffixes
+            and grid.flags.c_contiguous
+            and grid.flags.writeable)
+
+
+def scatter_add(grid, pixels, weights=None):
+    """
+    Add into grid (in place) at each of the flat pixel indices.
+
+    * grid -- C-contiguous numpy array, treated as raveled
+    * pixels -- Indices into the raveled grid; out-of-range ones are skipped
+    * weights -- Amount to add at each index, converted to the grid's dtype
+                 (default is one per index)
+
+    Returns False (having done nothing) if the kernels are unavailable
+    for this grid, True otherwise.
+    """
+    if not available(grid):
+        return False
+
+    suffix = _suffixes[grid.dtype]
+    pixels = np.ascontiguousarray(pixels, dtype=np.int64)
+    if weights is None:
+        getattr(_lib, "scatter_count_" + suffix)(
+            pixels.ctypes.data, len(pixels), grid.ctypes.data, grid.size)
+    else:
+        weights = np.ascontiguousarray(weights, dtype=grid.dtype)
+        assert(len(weights) == len(pixels))
+        getattr(_lib, "scatter_add_" + suffix)(
+            pixels.ctypes.data, weights.ctypes.data, len(pixels),
+            grid.ctypes.data, grid.size)
+    return True
+
+
+def scatter_moments(grid, pixels, vals):
+    """
+    Fold values into running (count, mean, M2) moments in place, in one
+    pass (Welford's method).
+
+    * grid -- C-contiguous float64 (height, width, 3) array of moments
+    * pixels -- Indices of cells (raveled height x width); out-of-range
+                ones are skipped
+    * vals -- Value for each index
+
+    Returns False (having done nothing) if the kernels are unavailable
+    for this grid, True otherwise.
+    """
+    if (not available(grid) or grid.dtype != np.float64
+            or grid.ndim != 3 or grid.shape[2] != 3):
+        return False
+    pixels = np.ascontiguousarray(pixels, dtype=np.int64)
+    vals = np.ascontiguousarray(vals, dtype=np.float64)
+    assert(len(vals) == len(pixels))
+    _lib.scatter_moments_f8(pixels.ctypes.data, vals.ctypes.data,
+                            len(pixels), grid.ctypes.data, grid.size // 3)
+    return True
+
+
+def project_scatter(grid, x, y, vt, weights=None):
+    """
+    Project points and add them into grid (in place) in one pass,
+    without building the projected coordinates.
+
+    Points land where transform.cpp would put them (coordinates are
+    truncated toward zero); those outside the grid are skipped.
+
+    * grid -- C-contiguous (height, width) numpy array
+    * x, y -- Canvas-space coordinate columns (float32 or float64, same
+              dtype, may be strided such as columns of an N x 4 array)
+    * vt -- View transform [tx, ty, sx, sy]
+    * weights -- Amount to add for each point, converted to the grid's
+                 dtype (default is one per point)
+
+    Returns False (having done nothing) if the kernels are unavailable
+    for these arrays, True otherwise.
+    """
+    x = np.asarray(x)
+    y = np.asarray(y)
+    if (not available(grid) or grid.ndim != 2
+            or x.dtype not in _coordinate_suffixes or y.dtype != x.dtype):
+        return False
+
+    (height, width) = grid.shape
+    count = len(x)
+    assert(len(y) == count)
+    vt = np.array(vt, dtype=x.dtype)
+    if weights is not None:
+        weights = np.ascontiguousarray(weights, dtype=grid.dtype)
+        assert(len(weights) == count)
+    name = "project_scatter_%s_%s" % (_coordinate_suffixes[x.dtype],
+                                      _suffixes[grid.dtype])
+    getattr(_lib, name)(
+        x.ctypes.data, x.strides[0] // x.itemsize if count else 0,
+        y.ctypes.data, y.strides[0] // y.itemsize if count else 0,
+        None if weights is None else weights.ctypes.data,
+        count, vt.ctypes.data, grid.ctypes.data, width, height)
+    return True
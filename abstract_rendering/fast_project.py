@@ -6,6 +6,18 @@ interchangeable.
 All functions will take as inputs a transform and an array of AABB
 using floating point numbers. The result will be quantized into
 integers.
+
+Inputs may be float64 or float32; the transform is applied in the
+input precision.  Float32 halves the memory (and bandwidth) of the
+inputs.  Its precision envelope: a coordinate lands within about
+3 * M * 2**-24 pixels of its float64 position, where M is the larger of
+|sx*x| and |tx| (|sy*y| and |ty| for y), i.e. the pixel magnitudes
+before and after translation.  So with M below 2**16 (views within
+65536 pixels of the canvas origin) the error is under 0.003 pixels, and
+only glyphs that close to a pixel boundary can shift by one pixel; the
+error reaches a whole pixel around M = 2**22.  Coordinates themselves
+keep 24 significant bits (longitudes, for example, to about 1e-5
+degrees).
 """
 from __future__ import print_function
 import ctypes
@@ -41,103 +53,217 @@ _lib_filename = 'transform{0}'.format(so_ext)
 _lib = ctypes.CDLL(os.path.join(os.path.dirname(__file__), _lib_filename))
 _type_lib(_lib)
 
-try:
-    _lib_filename = "transform_libdispatch{0}".format(so_ext)
-    _lib_dispatch = ctypes.CDLL(os.path.join(os.path.dirname(__file__), _lib_filename))
-    _type_lib(_lib_dispatch)
-except OSError:
-    _lib_dispatch = _lib
-
+def _load_optional(name):
+    "Load one of the optional projection libraries (None if not built)."
+    try:
+        lib = ctypes.CDLL(os.path.join(os.path.dirname(__file__),
+                                       name + so_ext))
+    except OSError:
+        return None
+    _type_lib(lib)
+    return lib
+
+# std::thread based library (built on linux), same results as _lib
+# but spreads large projections over all cores.  Used by default.
+_lib_threads = _load_optional("transform_threads")
+_lib_default = _lib_threads or _lib
+
+# Used when 'use_dispatch' is requested: libdispatch (OS X) if built,
+# otherwise whichever library is the default.
+_lib_dispatch = _load_optional("transform_libdispatch") or _lib_default
+
+PyBUF_READ = 0x100
 if sys.version_info.major > 2:
     mk_buff = ctypes.pythonapi.PyMemoryView_FromMemory
+    mk_buff.argtypes = [ctypes.c_void_p, ctypes.c_ssize_t, ctypes.c_int]
 else:
     mk_buff = ctypes.pythonapi.PyBuffer_FromMemory
-    mk_buff.restype = ctypes.py_object
+    mk_buff.argtypes = [ctypes.c_void_p, ctypes.c_ssize_t]
+mk_buff.restype = ctypes.py_object
 
-def _projectRects(viewxform, inputs, outputs, use_dispatch = False):
-    if (inputs.flags.f_contiguous): 
-        inputs = inputs.T
-        outputs = outputs.T
 
-    assert(len(inputs.shape) == 2 and inputs.shape[0] == 4)
-    assert(inputs.shape == outputs.shape)
+def _read_buffer(address, size):
+    "Read-only python buffer over memory owned by the native library."
+    if sys.version_info.major > 2:
+        return mk_buff(address, size, PyBUF_READ)
+    return mk_buff(address, size)
 
-    use_lib = _lib_dispatch if use_dispatch else _lib
+def _column_major(a):
+    """Is each column of the 2D array contiguous?  True for fortran-order
+       arrays and for row-slices of them (such as chunks of a larger set)."""
+    return a.flags.f_contiguous or (a.ndim == 2 and a.strides[0] == a.itemsize)
 
-    if inputs.dtype == np.float64:
-        inputtype = ctypes.c_double
-        func = use_lib.transform_d
-    elif inputs.dtype == np.float32:
-        inputtype = ctypes.c_float
-        func = use_lib.transform_f
-    else:
-        raise TypeError("ProjectRects only works for np.float32 and np.float64 inputs")
 
-    assert(outputs.dtype == np.int32)
-
-    t = ctypes.POINTER(inputtype)
-    cast = ctypes.cast
-    c_xforms = (inputtype * 4)(*viewxform)
-    c_inputs = (t * 4)(*(cast(inputs[i].ctypes.data, t) 
-                         for i in range(0, 4)))
-    c_outputs = (t* 4)(*(cast(outputs[i].ctypes.data, t)
-                         for i in range(0,4)))
-    func(ctypes.byref(c_xforms),
-         ctypes.byref(c_inputs),
-         ctypes.byref(c_outputs),
-         0,
-         inputs.shape[1])
+_ctypes = {np.dtype(np.float32): ctypes.c_float,
+           np.dtype(np.float64): ctypes.c_double}
+_functions = {}
+
+
+def _typed_function(lib, dtype):
+    """The (cached) transform function of lib for the input dtype,
+       with the ctype of its transform parameters."""
+    key = (lib._name, dtype)
+    if key not in _functions:
+        if dtype not in _ctypes:
+            raise TypeError("ProjectRects only works for np.float32 and np.float64 inputs")
+        name = "transform_f" if dtype == np.float32 else "transform_d"
+        _functions[key] = (getattr(lib, name), _ctypes[dtype] * 4)
+    return _functions[key]
+
+
+def _row_addresses(a):
+    "Pointers to the (contiguous) rows of a 2D array."
+    base = a.__array_interface__["data"][0]
+    return (ctypes.c_void_p * 4)(*[base + i*a.strides[0] for i in range(4)])
+
+
+class Projector(object):
+    """
+    Repeatedly project one set of glyphs into one output buffer.
+
+    All validation and ctypes setup happens once, here, so each call
+    only marshals the view transform.  Use it when projecting many small
+    ranges of a large set (e.g. chunks) or re-projecting on every frame.
+
+    * inputs -- float32/float64 glyphs, either (4, N) with contiguous rows
+                or (N, 4) with contiguous columns (fortran order).
+                Any buffer-protocol object numpy can view without copying.
+    * outputs -- int32 buffer laid out like inputs, with room for the
+                 largest range that will be projected at once
+    * use_dispatch -- Use the parallel library (see _lib_dispatch)
+    * ensure_visible -- Widen glyphs that project to zero width (x1 == x0)
+                        or height (y1 == y0) to one pixel, so every glyph
+                        covers at least one pixel (default is False)
+
+    The arrays are referenced (not copied), so later changes to inputs
+    are seen by later calls.
+    """
+    def __init__(self, inputs, outputs, use_dispatch=False,
+                 ensure_visible=False):
+        inputs = np.asarray(inputs)
+        outputs = np.asarray(outputs)
+        if _column_major(inputs):
+            inputs = inputs.T
+            outputs = outputs.T
+
+        if inputs.ndim != 2 or inputs.shape[0] != 4:
+            raise ValueError("Inputs must have four coordinates per glyph")
+        if outputs.shape[0] != 4 or outputs.dtype != np.int32:
+            raise ValueError("Outputs must be int32 with four coordinates per glyph")
+        if inputs.strides[1] != inputs.itemsize \
+           or outputs.strides[1] != outputs.itemsize:
+            raise ValueError("Each coordinate must be contiguous")
+        if not outputs.flags.writeable:
+            raise ValueError("Outputs must be writeable")
+
+        use_lib = _lib_dispatch if use_dispatch else _lib_default
+        (self._func, xform_type) = _typed_function(use_lib, inputs.dtype)
+        self._xform = xform_type()
+        self._c_xform = ctypes.byref(self._xform)
+        self._arrays = (inputs, outputs)
+        self._c_inputs = ctypes.byref(_row_addresses(inputs))
+        self._c_outputs = ctypes.byref(_row_addresses(outputs))
+        self.size = inputs.shape[1]
+        self.capacity = outputs.shape[1]
+        self.ensure_visible = ensure_visible
+
+    def __call__(self, viewxform, offset=0, count=None):
+        """
+        Project glyphs [offset, offset+count) into the first count
+        positions of the outputs.
+
+        * viewxform -- convert canvas space to pixel space [tx,ty,sx,sy]
+        * offset -- First glyph to project
+        * count -- Number of glyphs (default is the rest of the glyphs)
+        """
+        if count is None:
+            count = self.size - offset
+        if offset < 0 or count < 0 or offset + count > self.size:
+            raise ValueError("Range %d:%d is outside of the %d inputs"
+                             % (offset, offset+count, self.size))
+        if count > self.capacity:
+            raise ValueError("Outputs only have room for %d glyphs"
+                             % self.capacity)
+        if count:
+            self._xform[:] = viewxform
+            self._func(self._c_xform, self._c_inputs, self._c_outputs,
+                       offset, count)
+            if self.ensure_visible:
+                outputs = self._arrays[1]
+                for (low, high) in [(0, 2), (1, 3)]:
+                    high = outputs[high, :count]
+                    high += (high == outputs[low, :count])
+
+
+def _projection_buffer(inputs, out=None):
+    """An int32 array to project inputs into.  Reuses the leading rows of
+       out (e.g., an earlier frame's buffer) when it has room and the
+       same column-major layout, otherwise allocates one like inputs.
+       Returns (buffer for inputs, buffer to keep for reuse)."""
+    n = len(inputs)
+    if (out is not None and out.dtype == np.int32 and out.ndim == 2
+            and out.shape[1] == inputs.shape[1] and len(out) >= n
+            and _column_major(inputs) and _column_major(out[:n])):
+        return (out[:n], out)
+    fresh = np.empty_like(inputs, dtype=np.int32)
+    return (fresh, fresh)
+
+
+def _projectRects(viewxform, inputs, outputs, use_dispatch = False,
+                  ensure_visible = False):
+    """Project glyphs (see Projector) into an int32 array of the same shape.
+       With ensure_visible, zero width/height glyphs are widened to one
+       pixel, so the outputs are ready to aggregate."""
+    if inputs.size == 0:
+        return
+    if inputs.shape != outputs.shape:
+        raise ValueError("Inputs and outputs must have the same shape")
+    Projector(inputs, outputs, use_dispatch, ensure_visible)(viewxform)
         
 
 def _projectRectsGenerator(viewxform,
                            inputs,
                            chunk_size,
                            use_dispatch = False):
-    if (inputs.flags.f_contiguous):
+    """Project inputs in chunks of (at most) chunk_size glyphs.
+
+    Yields (4, n) int32 arrays (one row per coordinate).  Each array is
+    a view into a buffer that is reused, so it is only valid until the
+    next chunk is requested.  With an asynchronous library (use_dispatch
+    and libdispatch or the threaded library built) the next chunk is
+    projected in the background while the current one is consumed.
+    """
+    if inputs.size == 0:
+        return
+    if _column_major(inputs):
         inputs = inputs.T
-        # FIXME: outputs is undefined?
-        outputs = outputs.T
 
     assert(len(inputs.shape) == 2 and inputs.shape[0] == 4)
+    assert(inputs.strides[1] == inputs.itemsize)
     result_size = inputs.shape[1]
     chunk_size = min(result_size, chunk_size)
 
-    use_lib = _lib_dispatch if use_dispatch else _lib
+    use_lib = _lib_dispatch if use_dispatch else _lib_default
     if inputs.dtype == np.float64:
         inputtype = ctypes.c_double
-        func = use_lib.transform_d
         has_async = hasattr(use_lib, "async_transform_d_start")
     elif inputs.dtype == np.float32:
         inputtype = ctypes.c_float
-        func = use_lib.transform_f
         has_async = hasattr(use_lib, "async_transform_f_start")
     else:
         raise TypeError("ProjectRects only works for np.float32 and np.float64 inputs")
 
-    t = ctypes.POINTER(inputtype)
-    cast = ctypes.cast
-    c_xforms = (inputtype * 4)(*viewxform)
-    c_inputs = (t*4)(*(cast(inputs[i].ctypes.data, t)
-                       for i in range(0,4)))
-
     if not has_async:
-        print("no async")
         # simple case: no need to pipeline
         outputs = np.empty((4, chunk_size), dtype=np.int32)
-        c_outputs = (t*4)(*(cast(outputs[i].ctypes.data, t)
-                            for i in range(0, 4)))
+        project = Projector(inputs, outputs, use_dispatch)
         offset = 0
         while offset != result_size:
             curr_size = min(result_size - offset, chunk_size)
-            func(ctypes.byref(c_xforms),
-                 ctypes.byref(c_inputs),
-                 ctypes.byref(c_outputs),
-                 offset,
-                 curr_size)
+            project(viewxform, offset, curr_size)
             offset += curr_size
-            yield outputs[0:curr_size]
+            yield outputs[:, 0:curr_size]
     else:
-        print("async")
         if inputs.dtype == np.float64:
             start_function = use_lib.async_transform_d_start
             end_function  = use_lib.async_transform_d_end
@@ -149,22 +275,32 @@ def _projectRectsGenerator(viewxform,
         else:
             raise TypeError("ProjectRects only works for np.float32 and np.float64 inputs")
 
+        t = ctypes.POINTER(inputtype)
+        cast = ctypes.cast
+        c_xforms = (inputtype * 4)(*viewxform)
+        c_inputs = (t*4)(*(cast(inputs[i].ctypes.data, t)
+                           for i in range(0,4)))
+
         buff = ctypes.c_void_p(0)
         count = ctypes.c_size_t(0)
         total_size = chunk_size * 4 * 4
         token = start_function(ctypes.byref(c_xforms), ctypes.byref(c_inputs),
                                ctypes.c_size_t(result_size),
                                ctypes.c_size_t(chunk_size))
+        if not token:
+            raise MemoryError("Could not allocate projection buffers")
 
-        while True:
-            next_function(token, ctypes.byref(buff), ctypes.byref(count))
-            if count.value == 0:
-                break
-
-            yield np.frombuffer(mk_buff(buff, total_size, PyBuff_READ),
-                                dtype='i4').reshape((4,chunk_size))[:,0:count.value]
+        try:
+            while True:
+                next_function(token, ctypes.byref(buff), ctypes.byref(count))
+                if count.value == 0:
+                    break
 
-        end_function(token)
+                chunk = np.frombuffer(_read_buffer(buff.value, total_size),
+                                      dtype='i4').reshape((4, chunk_size))
+                yield chunk[:, 0:count.value]
+        finally:
+            end_function(token)
 
 # testing code starts here
 
@@ -188,6 +324,35 @@ def report_diffs(a, b, name):
                       (name, i, str(a[:,i]), str(b[:,i])))
 
 
+def call_overhead(sizes=(10**3, 10**5, 10**7), budget=.5):
+    """Microbenchmark: time per projection call at several input sizes,
+       for the one-shot _projectRects and for a reused Projector.
+       Each measurement repeats calls for about 'budget' seconds."""
+    from time import time
+
+    xform = [3.0, 4.0, 2.0, 2.0]
+    print("%10s %18s %18s %12s" % ("glyphs", "_projectRects (us)",
+                                   "Projector (us)", "saved (us)"))
+    for size in sizes:
+        inputs = np.random.random((4, size))
+        outputs = np.empty((4, size), dtype=np.int32)
+        project = Projector(inputs, outputs)
+
+        def per_call(f):
+            f()
+            reps = 0
+            start = time()
+            while reps == 0 or time() - start < budget:
+                f()
+                reps += 1
+            return (time() - start) / reps * 1e6
+
+        oneshot = per_call(lambda: _projectRects(xform, inputs, outputs))
+        reused = per_call(lambda: project(xform))
+        print("%10d %18.2f %18.2f %12.2f"
+              % (size, oneshot, reused, oneshot - reused))
+
+
 def simple_test():
     from time import time
 
@@ -272,4 +437,7 @@ def simple_test():
 
 
 if __name__ == '__main__':
-    simple_test()
+    if "overhead" in sys.argv:
+        call_overhead()
+    else:
+        simple_test()
@@ -1,4 +1,5 @@
 from __future__ import print_function, division, absolute_import
+import numpy as np
 
 
 def bressenham(canvas, line, val):
@@ -29,3 +30,268 @@ def bressenham(canvas, line, val):
         if e2 < dx:
             err = err + dx
             y0 = y0 + sy
+
+
+def clip_rects(rects, screen):
+    """
+    Clip rectangles to the screen.
+
+    * rects -- Array of [x0, y0, x1, y1] rows (x1/y1 exclusive)
+    * screen -- (width, height) to clip to
+
+    Returns (x0, y0, x1, y1) index arrays.  Rectangles that miss the
+    screen entirely come back empty (x1 == x0 or y1 == y0).
+    """
+    (width, height) = screen
+    rects = np.asarray(rects)
+    x0 = np.clip(rects[:, 0], 0, width).astype(np.intp)
+    y0 = np.clip(rects[:, 1], 0, height).astype(np.intp)
+    x1 = np.clip(rects[:, 2], x0, width).astype(np.intp)
+    y1 = np.clip(rects[:, 3], y0, height).astype(np.intp)
+    return (x0, y0, x1, y1)
+
+
+def cull(glyphs, shapecode, screen):
+    """
+    Drop projected glyphs that miss the screen and clamp the rest to it.
+
+    Points and rects are kept if they overlap [0, width) x [0, height)
+    and are clamped to it.  Lines are kept if their bounding box overlaps
+    the screen but are not clamped (that would change their slope);
+    the line scans clip them pixel by pixel.
+
+    * glyphs -- Array of projected glyphs, one per row
+    * shapecode -- How to interpret the glyph rows
+    * screen -- (width, height) of the grid being rendered into
+
+    Returns (kept glyphs, positions of the kept glyphs).  The glyphs are
+    returned unchanged (not copied) when nothing is dropped or clamped.
+    """
+    from abstract_rendering.glyphset import ShapeCodes
+
+    (width, height) = screen
+    glyphs = np.asarray(glyphs)
+    if len(glyphs) == 0:
+        return (glyphs, np.arange(0))
+
+    (x0, y0, x1, y1) = (glyphs[:, 0], glyphs[:, 1], glyphs[:, 2], glyphs[:, 3])
+    if shapecode == ShapeCodes.LINE:
+        keep = ((np.maximum(x0, x1) >= 0) & (np.minimum(x0, x1) < width) &
+                (np.maximum(y0, y1) >= 0) & (np.minimum(y0, y1) < height))
+    else:
+        keep = (x1 > 0) & (x0 < width) & (y1 > 0) & (y0 < height)
+
+    positions = np.flatnonzero(keep)
+    kept = glyphs
+    if len(positions) < len(glyphs):
+        kept = np.asfortranarray(glyphs[positions])
+
+    if shapecode != ShapeCodes.LINE and len(kept):
+        low = kept.min(axis=0)
+        high = kept.max(axis=0)
+        if (low < 0).any() or high[0::2].max() > width or high[1::2].max() > height:
+            if kept is glyphs:
+                kept = glyphs.copy(order="K")
+            np.clip(kept[:, 0::2], 0, width, out=kept[:, 0::2])
+            np.clip(kept[:, 1::2], 0, height, out=kept[:, 1::2])
+    return (kept, positions)
+
+
+def rect_pixels(rects, screen):
+    """
+    Find the pixels covered by many rectangles at once.
+
+    * rects -- Array of [x0, y0, x1, y1] rows (x1/y1 exclusive), as produced
+               by projecting a glyphset
+    * screen -- (width, height) of the grid; rects are clipped to it
+
+    Returns (glyphs, pixels) where pixels are indices into the raveled
+    (height, width) grid and glyphs[i] is the row of rects covering pixels[i].
+    """
+    (width, height) = screen
+    (x0, y0, x1, y1) = clip_rects(rects, screen)
+    w = x1 - x0
+    areas = w * (y1 - y0)
+
+    if (areas == 1).all():
+        # Common case: every glyph is a single pixel, skip the expansion
+        return (np.arange(len(areas)), y0*width + x0)
+
+    glyphs = np.repeat(np.arange(len(areas)), areas)
+    starts = np.cumsum(areas) - areas
+    offsets = np.arange(len(glyphs)) - starts[glyphs]
+    rw = w[glyphs]
+    pixels = (y0[glyphs] + offsets // rw)*width + x0[glyphs] + offsets % rw
+    return (glyphs, pixels)
+
+
+def rect_coverage(rects, screen, weights=None):
+    """
+    Sum weights over the pixels covered by many rectangles at once.
+
+    Uses a difference grid: each rectangle only touches its four corners,
+    then a cumulative sum along each axis fills in the interiors.  Cost is
+    O(N + width*height), independent of how large the rectangles are.
+
+    * rects -- Array of [x0, y0, x1, y1] rows (x1/y1 exclusive)
+    * screen -- (width, height) of the grid; rects are clipped to it
+    * weights -- Value of each rectangle (default is one per rectangle)
+
+    Returns a (height, width) grid, int64 when weights is None,
+    otherwise float64.
+    """
+    (width, height) = screen
+    (x0, y0, x1, y1) = clip_rects(rects, screen)
+    keep = (x1 > x0) & (y1 > y0)
+    (x0, y0, x1, y1) = (x0[keep], y0[keep], x1[keep], y1[keep])
+
+    stride = width + 1
+    size = (height + 1) * stride
+    adds = np.concatenate([y0*stride + x0, y1*stride + x1])
+    subs = np.concatenate([y0*stride + x1, y1*stride + x0])
+    if weights is None:
+        diffs = (np.bincount(adds, minlength=size)
+                 - np.bincount(subs, minlength=size))
+    else:
+        weights = np.tile(np.asarray(weights, dtype=np.float64)[keep], 2)
+        diffs = (np.bincount(adds, weights=weights, minlength=size)
+                 - np.bincount(subs, weights=weights, minlength=size))
+
+    diffs = diffs.reshape((height + 1, stride))
+    np.cumsum(diffs, axis=0, out=diffs)
+    np.cumsum(diffs, axis=1, out=diffs)
+    return diffs[:height, :width]
+
+
+def line_pixels(lines, screen):
+    """
+    Rasterize many lines at once by stepping them in lockstep.
+
+    Each step of the loop advances every unfinished line by one pixel
+    (using the same decisions as bressenham), so the number of Python-level
+    iterations is the length of the longest line, not the number of pixels.
+    Lines are first clipped to the screen (see _clip_walk), so only the
+    on-screen part of a line is stepped.
+
+    * lines -- Array of [x0, y0, x1, y1] rows.  As with glyphAggregates,
+               (x1, y1) is an exclusive corner: the last pixel drawn is one
+               step short of it along each axis.
+    * screen -- (width, height) of the grid; pixels outside are dropped
+
+    Yields one (glyphs, pixels) batch per step, as described in rect_pixels.
+    """
+    (width, height) = screen
+    lines = np.asarray(lines).astype(np.intp)
+    glyphs = np.arange(len(lines))
+    (x0, y0, x1, y1) = lines.T
+    x1 = x1 - np.sign(x1 - x0)
+    y1 = y1 - np.sign(y1 - y0)
+
+    dx = np.abs(x1 - x0)
+    dy = np.abs(y1 - y0)
+    sx = np.where(x0 < x1, 1, -1)
+    sy = np.where(y0 < y1, 1, -1)
+
+    (visible, first, last) = _clip_walk(x0, y0, x1, y1, screen)
+    (glyphs, x0, y0, dx, dy, sx, sy, first, last) = \
+        [a[visible] for a in (glyphs, x0, y0, dx, dy, sx, sy, first, last)]
+    # Start and end each walk at its first and last on-screen steps
+    (i, j) = _walk_offsets(dx, dy, last)
+    (x1, y1) = (x0 + sx*i, y0 + sy*j)
+    (i, j) = _walk_offsets(dx, dy, first)
+    (x0, y0) = (x0 + sx*i, y0 + sy*j)
+    err = dx - dy - i*dy + j*dx
+
+    while len(glyphs) > 0:
+        inside = (x0 >= 0) & (x0 < width) & (y0 >= 0) & (y0 < height)
+        yield (glyphs[inside], (y0*width + x0)[inside])
+
+        active = (x0 != x1) | (y0 != y1)
+        if not active.all():
+            (glyphs, x0, y0, x1, y1, dx, dy, err, sx, sy) = \
+                [a[active] for a in (glyphs, x0, y0, x1, y1,
+                                     dx, dy, err, sx, sy)]
+
+        e2 = err * 2
+        step = e2 > -dy
+        err = err - dy*step
+        x0 = x0 + sx*step
+        step = e2 < dx
+        err = err + dx*step
+        y0 = y0 + sy*step
+
+
+def _walk_offsets(dx, dy, steps):
+    """
+    How far (along x and along y) the Bresenham walk of a line with
+    extents (dx, dy) is after a number of steps.
+
+    The walk steps along its major axis every time, and along its minor
+    axis when that takes it to within half a pixel of the true line
+    (ties stay put), so the minor offset after t steps is
+    ceil(t*minor/major - 1/2).
+    """
+    major = np.maximum(np.maximum(dx, dy), 1)
+    minor = np.minimum(dx, dy)
+    offset = -((major - 2*steps*minor) // (2*major))
+    x_major = dx >= dy
+    return (np.where(x_major, steps, offset), np.where(x_major, offset, steps))
+
+
+def _clip_walk(x0, y0, x1, y1, screen):
+    """
+    Clip the Bresenham walks from (x0, y0) to (x1, y1) (inclusive) to the
+    screen, with Liang-Barsky clipping of the true lines.
+
+    A pixel of the walk is within half a pixel of the true line along the
+    minor axis, so the true line is clipped to the screen grown by a pixel
+    on every side, and the result rounded outwards.  The steps kept may
+    include a few off-screen pixels (line_pixels drops them), but never
+    leave out an on-screen one.
+
+    Returns (visible, first, last): which lines touch the screen, and the
+    range of steps of each walk to take.
+    """
+    (width, height) = screen
+    (dx, dy) = (x1 - x0, y1 - y0)
+    steps = np.maximum(np.abs(dx), np.abs(dy))
+    low = np.zeros(len(x0))
+    high = np.ones(len(x0))
+    visible = np.ones(len(x0), dtype=bool)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for (p, q) in [(-dx, x0 + 1), (dx, width - x0),
+                       (-dy, y0 + 1), (dy, height - y0)]:
+            bound = q / p
+            visible &= (p != 0) | (q >= 0)
+            low = np.where(p < 0, np.maximum(low, bound), low)
+            high = np.where(p > 0, np.minimum(high, bound), high)
+    visible &= low <= high
+
+    first = np.maximum(np.floor(low * steps), 0).astype(np.intp)
+    last = np.minimum(np.ceil(high * steps), steps).astype(np.intp)
+    return (visible & (first <= last), first, last)
+
+
+def pixels(glyphs, shapecode, screen):
+    """
+    Generate the pixels touched by a whole set of (projected) glyphs.
+
+    Yields (glyphs, pixels) batches as described in rect_pixels.
+    POINT glyphs cover the same region as a RECT with the same corners,
+    matching GlyphAggregator.glyphAggregates.
+
+    * glyphs -- Array of projected glyphs, one per row
+    * shapecode -- How to interpret the glyph rows
+    * screen -- (width, height) of the grid being rendered into
+    """
+    # Local import: glyphset depends on fast_project, keep geometry light
+    from abstract_rendering.glyphset import ShapeCodes
+
+    if shapecode in (ShapeCodes.POINT, ShapeCodes.RECT):
+        yield rect_pixels(glyphs, screen)
+    elif shapecode == ShapeCodes.LINE:
+        for batch in line_pixels(glyphs, screen):
+            yield batch
+    else:
+        raise ValueError("No vectorized pixel scan for shapecode %s"
+                         % shapecode)
@@ -2,7 +2,8 @@ from __future__ import print_function, division, absolute_import
 from six.moves import map
 import numpy as np
 import re
-from abstract_rendering.fast_project import _projectRects
+from abstract_rendering.fast_project import _projectRects, _projection_buffer
+import abstract_rendering.geometry as geometry
 import six
 
 def enum(**enums): return type('Enum', (), enums)
@@ -23,55 +24,130 @@ class Glyphset(object):
     """
     _points = None
     _data = None
+    _shaped = None
     shaper = None
+    colMajor = False
+    spatial = None
+    culled = 0
+    buffer = None
 
     def __init__(self, points, data, shaper, colMajor=False):
         self._points = points
         self._data = data
         self.shaper = shaper
-        self.shaper.colMajor = colMajor  # HACK: This modification is bad form...would rather do a copy
+        self.colMajor = colMajor
 
     # TODO: Add the ability to get points m...n
     def points(self):
-        """Returns the set of [x,y,w,h] points for this glyphset.
+        """Returns the set of [x,y,w,h] points for this glyphset, as an
+           N x 4 array with contiguous columns.
            Access to raw data is through _points.
+
+           Literal arrays (and Columns) are returned without copying.
+           Lists and shaped glyphs are converted on the first call and
+           the result is kept for later ones.
         """
+        points = self._points
+        if isinstance(points, Columns):
+            points = points.points()
 
         if (type(self.shaper) is Literals):
-            if type(self._points) is list:
-                return np.array(self._points, order="F")
-            elif type(self._points) is np.ndarray:
-                return self._points
-            else:
-                ValueError("Unhandled (literal) points type: %s"
-                           % type(self._points))
-        else:
-            # TODO: Setup the shaper utilities to go directly to fortran order
-            return np.array(self.shaper(self._points), order="F")
+            if isinstance(points, np.ndarray):
+                return points
+            elif type(points) is not list:
+                raise ValueError("Unhandled (literal) points type: %s"
+                                 % type(points))
+
+        if self._shaped is None:
+            if type(self.shaper) is not Literals:
+                points = self.shaper(points, self.colMajor)
+            self._shaped = np.array(points, order="F")
+        return self._shaped
+
+    def buildIndex(self, bins=None):
+        """Build a spatial index (see SpatialIndex) over the glyphs.
+           Afterwards, project only touches glyphs that may be visible
+           on the screen it is given.  Returns this glyphset.
+
+           bins -- Buckets per axis (default sized from the glyph count)
+        """
+        self.spatial = SpatialIndex(self.points(), self.shaper.code, bins)
+        return self
 
-    def project(self, viewxform):
+    def project(self, viewxform, screen=None, out=None):
         """Project the points found in the glyphset according to the view transform.
 
         viewxform -- convert canvas space to pixel space [tx,ty,sx,sy]
+        screen -- (width, height) of the canvas.  If given, glyphs that
+                  miss it are culled and the rest clipped to it (see
+                  geometry.cull); the result's 'culled' attribute counts
+                  the glyphs left out.  With a spatial index, culled
+                  glyphs are mostly never projected.
+        out -- Projection buffer to reuse, such as the 'buffer' of an
+               earlier projection (used if it fits)
         returns a new glyphset with projected points and associated info values
         """
         points = self.points()
-        out = np.empty_like(points, dtype=np.int32)
-        _projectRects(viewxform, points, out)
-
-        # Ensure visilibity, make sure w/h are always at least one
-        # TODO: There is probably a more numpy-ish way to do this...
-        for i in xrange(0, out.shape[0]):
-            if out[i, 0] == out[i, 2]:
-                out[i, 2] += 1
-            if out[i, 1] == out[i, 3]:
-                out[i, 3] += 1
-
-        return Glyphset(out, self.data(), Literals(self.shaper.code))
+        data = self.data()
+        total = len(points)
+        if self.spatial is not None and screen is not None:
+            visible = self.spatial.query(viewxform, screen)
+            if len(visible) < len(points):
+                points = np.asfortranarray(points[visible])
+                data = take(data, visible)
+
+        (out, buffer) = _projection_buffer(points, out)
+        _projectRects(viewxform, points, out, ensure_visible=True)
+
+        if screen is not None:
+            (out, kept) = geometry.cull(out, self.shaper.code, screen)
+            if len(kept) < len(points):
+                data = take(data, kept)
+
+        projected = Glyphset(out, data, Literals(self.shaper.code))
+        projected.culled = total - len(out)
+        projected.buffer = buffer
+        return projected
 
     def data(self):
         return self._data
 
+    def select(self, idxs):
+        """A glyphset of just the glyphs at the given positions."""
+        points = np.asfortranarray(self.points()[idxs])
+        return Glyphset(points, take(self.data(), idxs),
+                        Literals(self.shaper.code))
+
+    def near(self, viewxform, region):
+        """The glyphs that may touch a pixel region under the view
+           transform.  Without a spatial index, that is all of them.
+
+           viewxform -- convert canvas space to pixel space [tx,ty,sx,sy]
+           region -- Pixel rectangle (x0, y0, x1, y1), x1/y1 exclusive
+        """
+        if self.spatial is None:
+            return self
+        idxs = self.spatial.query(*_region_query(viewxform, region))
+        return self.select(idxs)
+
+    def partition(self, n):
+        """Split into (at most) n glyphsets of contiguous, similarly sized
+           ranges of glyphs.  Partitions share memory with this glyphset
+           where the points/data types allow it.
+        """
+        points = self.points()
+        data = self.data()
+        bounds = np.linspace(0, len(points), max(n, 1)+1).astype(int)
+        parts = []
+        for (start, stop) in zip(bounds[:-1], bounds[1:]):
+            if start == stop and parts:
+                continue
+            part_data = (data[start:stop] if hasattr(data, "__len__")
+                         else data)
+            parts.append(Glyphset(points[start:stop], part_data,
+                                  Literals(self.shaper.code)))
+        return parts
+
     def bounds(self):
         """Compute bounds of the glyph-set.  Returns (X,Y,W,H)
 
@@ -109,15 +185,178 @@ class Glyphset(object):
 #        return (minX, minY, maxX+width, maxY+height)
 
 
+class SpatialIndex(object):
+    """
+    Uniform bucket grid over the canvas-space bounding boxes of a glyphset.
+
+    Each glyph is filed under the bucket holding the low corner of its
+    bounding box.  Glyph positions are kept sorted by bucket (row-major),
+    with the start offset of each bucket, so every bucket row of a query
+    is one contiguous range.  A query widens its low side by the largest
+    glyph extent, so glyphs that spill into neighboring buckets are found,
+    and then checks the candidates' boxes exactly.  Work per query is
+    proportional to the glyphs in the touched buckets, not to all glyphs.
+
+    Glyphs with non-finite coordinates are not indexed (they are never
+    visible).  The index is built once; it is not updated if the points
+    are modified.
+
+    * points -- Canvas-space glyph points, (x,y,w,h) or (x1,y1,x2,y2) for lines
+    * shapecode -- How to interpret the points
+    * bins -- Buckets per axis (default targets a few dozen glyphs per bucket)
+    """
+    def __init__(self, points, shapecode, bins=None):
+        points = np.asarray(points)
+        if points.dtype.kind != "f":
+            points = points.astype(np.float64)
+        if points.size == 0:
+            points = np.zeros((0, 4))
+        (x0, y0, x1, y1) = self._boxes(points, shapecode)
+        finite = np.flatnonzero(np.isfinite(x0) & np.isfinite(y0)
+                                & np.isfinite(x1) & np.isfinite(y1))
+        (x0, y0, x1, y1) = (x0[finite], y0[finite], x1[finite], y1[finite])
+
+        if bins is None:
+            bins = int(min(max(np.sqrt(len(finite) / 32.0), 1), 1024))
+        self.bins = bins
+        self.shapecode = shapecode
+
+        if len(finite):
+            self.low = (x0.min(), y0.min())
+            high = (x0.max(), y0.max())
+            self.extent = ((x1 - x0).max(), (y1 - y0).max())
+        else:
+            self.low = high = self.extent = (0.0, 0.0)
+        self.cell = tuple(max(h - l, 1e-300) / bins
+                          for (l, h) in zip(self.low, high))
+
+        keys = self._bucket(y0, 1) * bins + self._bucket(x0, 0)
+        order = np.argsort(keys, kind="mergesort")
+        self.order = finite[order]
+        counts = np.bincount(keys, minlength=bins*bins)
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+        self.points = points
+
+    @staticmethod
+    def _boxes(points, shapecode):
+        "Bounding boxes (x0, y0, x1, y1) of glyph points."
+        if shapecode == ShapeCodes.LINE:
+            xs = points[:, [0, 2]]
+            ys = points[:, [1, 3]]
+        else:
+            xs = np.column_stack([points[:, 0], points[:, 0]+points[:, 2]])
+            ys = np.column_stack([points[:, 1], points[:, 1]+points[:, 3]])
+        return (xs.min(axis=1), ys.min(axis=1),
+                xs.max(axis=1), ys.max(axis=1))
+
+    def _bucket(self, vals, axis):
+        b = np.floor((np.asarray(vals) - self.low[axis]) / self.cell[axis])
+        return np.clip(b, 0, self.bins-1).astype(np.intp)
+
+    def window(self, viewxform, screen):
+        """Canvas-space box (x0, y0, x1, y1) that projects onto the screen,
+           padded by a pixel on each side for rounding."""
+        (tx, ty, sx, sy) = viewxform
+        (width, height) = screen
+        xs = sorted([(-1 - tx) / sx, (width + 1 - tx) / sx])
+        ys = sorted([(-1 - ty) / sy, (height + 1 - ty) / sy])
+        return (xs[0], ys[0], xs[1], ys[1])
+
+    def query(self, viewxform, screen):
+        """
+        Positions (in increasing order) of the glyphs that may be visible
+        on the screen under the view transform.
+
+        * viewxform -- Canvas to pixel transform [tx,ty,sx,sy]
+        * screen -- (width, height) of the canvas
+        """
+        (wx0, wy0, wx1, wy1) = self.window(viewxform, screen)
+        (c0, c1) = self._bucket([wx0 - self.extent[0], wx1], 0)
+        (r0, r1) = self._bucket([wy0 - self.extent[1], wy1], 1)
+
+        rows = np.arange(r0, r1+1) * self.bins
+        starts = self.offsets[rows + c0]
+        lengths = self.offsets[rows + c1 + 1] - starts
+        skip = np.cumsum(lengths) - lengths - starts
+        ranks = np.arange(lengths.sum()) - np.repeat(skip, lengths)
+        candidates = self.order[ranks]
+
+        (x0, y0, x1, y1) = self._boxes(self.points[candidates],
+                                       self.shapecode)
+        hit = (x1 >= wx0) & (x0 <= wx1) & (y1 >= wy0) & (y0 <= wy1)
+        return np.sort(candidates[hit])
+
+
+def _region_query(viewxform, region):
+    """View transform and screen that put a pixel region at the origin,
+       for querying a SpatialIndex."""
+    (tx, ty, sx, sy) = viewxform
+    (x0, y0, x1, y1) = region
+    return ((tx - x0, ty - y0, sx, sy), (x1 - x0, y1 - y0))
+
+
+class Columns(object):
+    """
+    Struct-of-arrays glyph storage: each coordinate (x, y, w, h) is one
+    contiguous array.  The arrays are the rows of a single (4, N) block,
+    so points() is an N x 4 view of them (with contiguous columns) and
+    the projection kernels read each coordinate in place.
+
+    Use as the points of a Glyphset with a Literals shaper.
+
+    * x, y -- Glyph positions (first endpoints, for lines)
+    * w, h -- Glyph sizes (second endpoints, for lines); default is 0
+    * dtype -- Storage type.  Default is that of x and y, but at least
+               float32 (which the projection kernels require).
+    """
+    def __init__(self, x, y, w=0, h=0, dtype=None):
+        (x, y) = (np.asarray(x), np.asarray(y))
+        if dtype is None:
+            dtype = np.result_type(x, y, np.float32)
+        self.block = np.empty((4, len(x)), dtype=dtype)
+        for (row, vals) in zip(self.block, (x, y, w, h)):
+            row[...] = vals
+
+    @property
+    def x(self):
+        return self.block[0]
+
+    @property
+    def y(self):
+        return self.block[1]
+
+    @property
+    def w(self):
+        return self.block[2]
+
+    @property
+    def h(self):
+        return self.block[3]
+
+    def __len__(self):
+        return self.block.shape[1]
+
+    def points(self):
+        "The glyphs as an N x 4 array, sharing memory with the columns."
+        return self.block.T
+
+
 # Shapers.....
 class Shaper(object):
     fns = None  # List of functions to apply
     code = None
     colMajor = False
 
-    # TODO: When getting subsets of the data out of glyphset.points(), remove this colMajor and handle it up in glyphset instead
-    def __call__(self, vals):
-        if not self.colMajor:
+    def __call__(self, vals, colMajor=None):
+        """Shape each value into glyph coordinates.
+
+        * vals -- Values to shape
+        * colMajor -- Are vals given as columns (one list per field)?
+                      Default is the shaper's colMajor attribute.
+        """
+        if colMajor is None:
+            colMajor = self.colMajor
+        if not colMajor:
             shapes = [list(map(lambda f: f(val), self.fns)) for val in vals]
         else:
             shapes = [list(map(lambda f: f(val), self.fns)) for val in zip(*vals)]
@@ -135,7 +374,7 @@ class Literals(Shaper):
     def __init__(self, code):
         self.code = code
 
-    def __call__(self, vals):
+    def __call__(self, vals, colMajor=None):
         return vals
 
 
@@ -194,12 +433,35 @@ def idx(i):
     return item(i)
 
 
-def load_csv(filename, skip, xc, yc, vc, width, height, shapecode):
+def take(data, idxs):
+    """
+    Select entries out of glyph data by position.
+    Handles numpy arrays, pandas objects and plain sequences.
+    Placeholders (None or non-length-carrying data) are returned unchanged.
+
+    * data -- Data associated with a glyphset
+    * idxs -- Integer positions to select
+    """
+    if data is None or not hasattr(data, "__len__"):
+        return data
+    elif hasattr(data, "iloc"):
+        return data.iloc[idxs]
+    elif isinstance(data, np.ndarray):
+        return data[idxs]
+    else:
+        return [data[i] for i in idxs]
+
+
+def load_csv(filename, skip, xc, yc, vc, width, height, shapecode,
+             dtype=np.float64):
     """Turn a csv file into a glyphset.
 
     This is a fairly naive regulary-expression based parser
     (it doesn't handle quotes, blank lines or much else).
     It is useful for getting simple datasets into the system.
+
+    dtype: Floating point type of the points, np.float64 (default) or
+           np.float32 (half the memory; see fast_project for precision)
     """
     source = open(filename, 'r')
     glyphs = []
@@ -222,10 +484,12 @@ def load_csv(filename, skip, xc, yc, vc, width, height, shapecode):
         data.append(v)
 
     source.close()
-    return Glyphset(glyphs, data, Literals(shapecode))
+    points = np.array(glyphs, dtype=dtype, order="F").reshape((-1, 4))
+    return Glyphset(points, data, Literals(shapecode))
 
 
-def load_hdf(filename, node, xc, yc, vc, width, height, shapecode):
+def load_hdf(filename, node, xc, yc, vc, width, height, shapecode,
+             dtype=np.float64):
     """
     Load a node from an HDF file.
 
@@ -238,15 +502,17 @@ def load_hdf(filename, node, xc, yc, vc, width, height, shapecode):
         If cats is an empty list, a coding will be automatically generated
         Any value not on the list will be assigned category equal to
         list length. Cats is ignored if vc is not supplied.
+    dtype: Floating point type of the points, np.float64 (default) or
+           np.float32 (half the memory; see fast_project for precision)
     """
     import pandas as pd
     table = pd.read_hdf(filename, node)
-    x = np.array(table[xc])
-    y = np.array(table[yc])
-    w = np.array([width] * len(x))
-    h = np.array([height] * len(x))
-    points = np.vstack([x, y, w, h]).T
-    data = table[vc] if vc else ([1] * len(x))
-    print("Loaded %d items" % len(x))
+    points = np.empty((len(table), 4), dtype=dtype, order="F")
+    points[:, 0] = table[xc]
+    points[:, 1] = table[yc]
+    points[:, 2] = width
+    points[:, 3] = height
+    data = table[vc] if vc else ([1] * len(points))
+    print("Loaded %d items" % len(points))
 
     return Glyphset(points, data, Literals(shapecode))
@@ -1,14 +1,53 @@
 """
 Each info function returns callable that can be used on a single
 entry in the dataset.
+
+The callables returned here also carry a 'column' attribute: a variant
+that takes the whole data column (ndarray, DataFrame/Series, list...)
+plus the number of glyphs and returns an array of info values in one pass.
+Use 'evaluate' to get info values for a whole dataset, it picks the
+column variant when one is available.
 """
 from __future__ import print_function, division, absolute_import
+import numpy as np
+
+
+def evaluate(info, data, size):
+    """Compute the info values for a whole dataset.
+
+    * info -- Info function to evaluate
+    * data -- Data associated with the glyphs (may be a placeholder)
+    * size -- Number of glyphs
+
+    Returns an array when info has a column variant,
+    otherwise a list built by calling info on each data entry.
+    """
+    column = getattr(info, "column", None)
+    if column is not None and (data is None or hasattr(data, "__len__")):
+        return column(data, size)
+
+    # co-iterating on size in case data is a non-length-carrying placeholder
+    return [info(d) for (d, _) in zip(data, range(size))]
+
+
+def _entries(f, data, size):
+    "Column fallback: call the per-entry info function on everything."
+    return np.asarray([f(d) for (d, _) in zip(data, range(size))])
+
+
+def _repeat(v, size):
+    return np.repeat([v], size, axis=0)
 
 
 def const(v):
     """Return the value passed."""
     def f(data):
         return v
+
+    def column(data, size):
+        return _repeat(v, size)
+
+    f.column = column
     return f
 
 
@@ -20,6 +59,20 @@ def val(default=None):
             return default
         else:
             return data
+
+    def column(data, size):
+        if data is None:
+            return _repeat(default, size)
+        values = np.asarray(data)
+        if values.dtype == object:
+            missing = np.equal(values, None)
+            if missing.any():
+                values = values.copy()
+                values[missing] = default
+            values = np.array(values.tolist())
+        return values
+
+    f.column = column
     return f
 
 
@@ -32,13 +85,50 @@ def valAt(i, default=None):
             return data[i]
         except:
             return default
+
+    def column(data, size):
+        if data is None:
+            return _repeat(default, size)
+        if hasattr(data, "iloc"):
+            if data.ndim == 2 and -data.shape[1] <= i < data.shape[1]:
+                return np.asarray(data.iloc[:, i])
+            return _repeat(default, size)
+        if isinstance(data, np.ndarray) and data.ndim == 2:
+            if -data.shape[1] <= i < data.shape[1]:
+                return data[:, i]
+            return _repeat(default, size)
+        return _entries(f, data, size)
+
+    f.column = column
     return f
 
 
+def _field(data, att):
+    """Get a named column out of a table-like data column.
+       Returns None if data is not table-like or has no such column."""
+    if hasattr(data, "columns"):
+        if att in data.columns:
+            return np.asarray(data[att])
+    elif isinstance(data, np.ndarray):
+        if data.dtype.names is not None and att in data.dtype.names:
+            return data[att]
+    return None
+
+
 def key(att, default=None):
     "Return the value under a given key in the data part of the input."
     def f(data):
         return data.get(att, default)
+
+    def column(data, size):
+        if isinstance(data, dict):
+            return np.asarray(data.get(att, _repeat(default, size)))
+        values = _field(data, att)
+        if values is not None:
+            return values
+        return _entries(f, data, size)
+
+    f.column = column
     return f
 
 
@@ -46,6 +136,14 @@ def attribute(att, default=None):
     "Return the value under a given attribute in the data part of the input."
     def f(data):
         return getattr(data, att, default)
+
+    def column(data, size):
+        values = _field(data, att)
+        if values is not None:
+            return values
+        return _entries(f, data, size)
+
+    f.column = column
     return f
 
 
@@ -63,6 +161,29 @@ def encode(cats, defcat=-1):
     def f(val):
         return codes.get(val, defcat)
 
+    # Sorted lookup table for the column variant: binary search into
+    # the sorted categories instead of one dictionary lookup per value.
+    # Built from codes, so duplicated categories get the same code.
+    ordered = None
+    if len(codes) > 0 and len(set(type(c) for c in codes)) == 1:
+        keys = np.asarray(list(codes.keys()))
+        order = np.argsort(keys, kind="mergesort")
+        ordered = keys[order]
+        order = np.asarray(list(codes.values()))[order]
+
+    def column(data, size):
+        if ordered is None:
+            return _entries(f, data, size)
+        values = np.asarray(data)
+        try:
+            idxs = np.searchsorted(ordered, values)
+        except TypeError:
+            return _entries(f, data, size)
+        idxs = np.minimum(idxs, len(ordered)-1)
+        hits = (ordered[idxs] == values)
+        return np.where(hits, order[idxs], defcat)
+
+    f.column = column
     return f
 
 
@@ -80,3 +201,17 @@ class AutoEncode(object):
             self.mapping[val] = self.next_code
             self.next_code = self.next_code + 1
         return self.mapping[val]
+
+    def column(self, data, size):
+        """Encode a whole column.  New values get codes in order of
+           first appearance, just as calling on each value would."""
+        values = np.asarray(data)
+        try:
+            (uniques, first, inverse) = np.unique(values, return_index=True,
+                                                  return_inverse=True)
+        except TypeError:
+            return np.asarray([self(v) for v in data])
+        codes = np.empty(len(uniques), dtype=np.intp)
+        for u in np.argsort(first, kind="mergesort"):
+            codes[u] = self(uniques[u])
+        return codes[inverse.ravel()]
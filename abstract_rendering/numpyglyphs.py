@@ -1,103 +1,516 @@
 from __future__ import print_function, division, absolute_import
-from six.moves import range
+from six.moves import range, reduce
 import numpy as np
 from scipy.ndimage.filters import convolve
-from abstract_rendering.fast_project import _projectRects
+from abstract_rendering.fast_project import _projectRects, _projection_buffer
+import abstract_rendering.fast_aggregate as fast_aggregate
 import abstract_rendering.glyphset as glyphset
+import abstract_rendering.infos as infos
+import abstract_rendering.util as util
 import abstract_rendering.core as ar
 
 
 class Glyphset(glyphset.Glyphset):
     # TODO: Default data is list of None (?)
     """
-    points: Base array of points (x, y, w, h)
+    points: Base array of points (x, y, w, h), or glyphset.Columns
     data: Base array of data associated with points.
           points[n] is associated with data[n]
     vt: view transform
     clean_nan: Remove entries with nans in points?  Default is false.
+    screen: (width, height) of the canvas.  If given, points that project
+            off of it are culled (counted in 'culled') from points() and
+            data().  The base points are kept whole, for later
+            projections.  Default is None.
+    out: Projection buffer to reuse (see glyphset.Glyphset.project)
+
+    Projection is lazy: it happens on the first call to points() (or
+    data(), when culling to a screen), so chained project calls only
+    compose transforms and bounds() works from the base points.
+    Aggregators may also read the base points and vt directly (see
+    PointCount).
+
+    Points may be float64 or float32; float32 points stay float32
+    through projection and aggregation (see fast_project for precision).
+
+    See cacheProjections to keep projections for views that recur.
     """
-    def __init__(self, points, data, vt=(0, 0, 1, 1), clean_nan=False):
+    cache = None
+
+    def __init__(self, points, data, vt=(0, 0, 1, 1), clean_nan=False,
+                 screen=None, out=None):
         if clean_nan:
             mask = ~np.isnan(points).any(axis=1)
             points = points[mask]
             data = data[mask]
 
+        if isinstance(points, glyphset.Columns):
+            points = points.points()
+
         self._points = points
         self._data = data
         self.vt = vt
         self.shaper = glyphset.ToPoint(glyphset.idx(0), glyphset.idx(1))
 
-        if not is_identity_transform(vt):
-            self.projected = np.empty_like(points, dtype=np.int32)
-            _projectRects(vt, points, self.projected)
+        # The base points stay whole for later projections.  Projection
+        # works on a view of them: all of them unless project picked a
+        # subset with the spatial index, less any culled to the screen.
+        # It waits for first use.
+        self._view = points
+        self._shown = data
+        self._projected = None
+        self._screen = screen
+        self._out = out
+        self._buffer = None
+        self._culled = 0
+
+    def _project(self):
+        "Project (and cull) the view of the base points, if not done yet."
+        if self._projected is not None:
+            return
+        points = self._view
+        if not is_identity_transform(self.vt):
+            (projected, self._buffer) = _projection_buffer(points, self._out)
+            _projectRects(self.vt, points, projected)
             # points must be at least 1 wide for general compatability
-            self.projected[:, 2] = self.projected[:, 0]+1
-            self.projected[:, 3] = self.projected[:, 1]+1
+            projected[:, 2] = projected[:, 0]+1
+            projected[:, 3] = projected[:, 1]+1
         else:
-            self.projected = points
+            projected = points
+        self._out = None
+
+        if self._screen is not None:
+            # Only the corner is meaningful (identity transforms keep w/h)
+            (width, height) = self._screen
+            (x, y) = (projected[:, 0], projected[:, 1])
+            kept = np.flatnonzero((x >= 0) & (x < width) &
+                                  (y >= 0) & (y < height))
+            if len(kept) < len(points):
+                projected = np.asfortranarray(projected[kept])
+                self._shown = glyphset.take(self._shown, kept)
+                self._culled += len(points) - len(kept)
+            self._screen = None
+        self._projected = projected
+
+    def _culledView(self):
+        "Make sure culling to the screen (which projects) is done."
+        if self._screen is not None:
+            self._project()
+
+    @property
+    def projected(self):
+        "Projected points (computed on first use)."
+        self._project()
+        return self._projected
+
+    @projected.setter
+    def projected(self, value):
+        self._projected = value
+        self._screen = None
+
+    @property
+    def culled(self):
+        "Points left out for being off of the screen (or by the index)."
+        self._culledView()
+        return self._culled
+
+    @culled.setter
+    def culled(self, value):
+        self._culled = value
+
+    @property
+    def buffer(self):
+        """Projection buffer to reuse: the one projected into or, before
+           projecting, the one that will be (see glyphset.Glyphset)."""
+        return self._out if self._projected is None else self._buffer
+
+    @buffer.setter
+    def buffer(self, value):
+        self._buffer = self._out = value
 
     def data(self):
-        return self._data
+        "Data of the projected points (see points)."
+        self._culledView()
+        return self._shown
 
     def points(self):
         return self.projected
 
-    def project(self, vt):
+    def viewPoints(self):
+        """The unprojected points that points() projects, before culling
+           to the screen.  For aggregators that project as they go."""
+        return self._view
+
+    def buildIndex(self, bins=None):
+        """Build a spatial index over the base (unprojected) points.
+           See glyphset.Glyphset.buildIndex."""
+        self.spatial = glyphset.SpatialIndex(self._points,
+                                             glyphset.ShapeCodes.POINT, bins)
+        return self
+
+    def cacheProjections(self, budget=64 * 2**20):
+        """Keep the results of project, keyed by the composed view
+           transform and screen, so returning to a view does not
+           project again.  The least recently used projections are
+           dropped to stay within the budget.  Returns this glyphset.
+
+           Projections from the cache are shared: treat their points
+           as read-only (they have no 'buffer' to reuse).
+
+           budget -- Memory for cached projections, in bytes
+        """
+        self.cache = util.LRUCache(budget)
+        return self
+
+    def select(self, idxs):
+        """A glyphset of the points at the given positions, under the
+           same transform."""
+        return Glyphset(np.asfortranarray(self._points[idxs]),
+                        glyphset.take(self._data, idxs), self.vt)
+
+    def near(self, vt, region):
+        """The points that may land in a pixel region once projected
+           with vt (see glyphset.Glyphset.near)."""
+        if self.spatial is None:
+            return self
+        query = glyphset._region_query(self._compose(vt), region)
+        return self.select(self.spatial.query(*query))
+
+    def _compose(self, vt):
+        "This glyphset's transform followed by vt."
+        return (self.vt[0]+vt[0],
+                self.vt[1]+vt[1],
+                self.vt[2]*vt[2],
+                self.vt[3]*vt[3])
+
+    def project(self, vt, screen=None, out=None):
         """
         Project the points found in the glyphset with to the transform.
 
         vt -- convert canvas space to pixel space [tx,ty,sx,sy]
+        screen -- (width, height) of the canvas.  If given, points off of
+                  it are culled; with a spatial index most of them are
+                  never projected.
+        out -- Projection buffer to reuse (see glyphset.Glyphset.project)
         returns a new glyphset with projected points and associated info values
         """
-        nvt = (self.vt[0]+vt[0],
-               self.vt[1]+vt[1],
-               self.vt[2]*vt[2],
-               self.vt[3]*vt[3])
-        return Glyphset(self._points, self._data, nvt)
+        nvt = self._compose(vt)
+        if self.cache is not None:
+            key = (tuple(float(v) for v in nvt),
+                   None if screen is None else tuple(screen))
+            cached = self.cache.get(key)
+            if cached is not None:
+                return self._cached(nvt, *cached)
+            out = None  # Cached arrays must not be shared with a context
+
+        projected = Glyphset(self._points, self._data, nvt,
+                             screen=screen, out=out)
+        if self.spatial is not None and screen is not None:
+            visible = self.spatial.query(nvt, screen)
+            if len(visible) < len(self._points):
+                projected._view = np.asfortranarray(self._points[visible])
+                projected._shown = glyphset.take(self._data, visible)
+                projected.culled = len(self._points) - len(visible)
+
+        if self.cache is not None:
+            projected.points()  # Project now, to keep the result
+            entry = (projected._view, projected._shown,
+                     projected.projected, projected.culled)
+            self.cache.put(key, entry, self._cacheSize(entry))
+            projected.buffer = None
+        return projected
+
+    def _cached(self, vt, view, shown, projected, culled):
+        "Glyphset for a cached projection."
+        rslt = Glyphset(self._points, self._data, vt)
+        (rslt._view, rslt._shown) = (view, shown)
+        rslt.projected = projected
+        rslt.culled = culled
+        return rslt
+
+    def _cacheSize(self, entry):
+        "Bytes held by a cache entry beyond this glyphset's own arrays."
+        arrays = [a for a in entry[:3] if isinstance(a, np.ndarray)
+                  and a is not self._points and a is not self._data]
+        return sum(a.nbytes for a in arrays)
 
     def bounds(self):
-        (xmax, ymax, _, _) = self.projected.max(axis=0)
-        (xmin, ymin, _, _) = self.projected.min(axis=0)
+        points = np.asarray(self._view)
+        if (self._projected is not None or self._screen is not None
+                or is_identity_transform(self.vt)
+                or points.dtype not in (np.float32, np.float64)):
+            (xmax, ymax, _, _) = self.projected.max(axis=0)
+            (xmin, ymin, _, _) = self.projected.min(axis=0)
+        else:
+            # Projection is monotone in each coordinate, so the extremes
+            # of the projected points are projections of the extremes.
+            (tx, ty, sx, sy) = np.asarray(self.vt, dtype=points.dtype)
+            lo = points[:, :2].min(axis=0)
+            hi = points[:, :2].max(axis=0)
+            xs = np.array([lo[0], hi[0]]) * sx + tx
+            ys = np.array([lo[1], hi[1]]) * sy + ty
+            (xmin, xmax) = np.sort(xs).astype(np.int32)
+            (ymin, ymax) = np.sort(ys).astype(np.int32)
         bounds = (xmin, ymin, xmax-xmin, ymax-ymin)
         return bounds
 
 
 class PointCount(ar.Aggregator):
-    def aggregate(self, glyphset, info, screen):
-        sparse = glyphset.points()
+    """Count the points that fall into each grid element.
+
+    Each point counts in the cell of its points() coordinates (floored,
+    if they are floats; see pixel_index), whatever path counts it.
+
+    For projected glyphsets from this module, points are projected and
+    counted in one native pass over the raw coordinates (see
+    fast_aggregate.project_scatter) when the kernels are available.
+    Otherwise the projected points are located with pixel_index and
+    scattered into the grid (see core.scatter_add).
+
+    * dtype -- Type of the counts grid (default np.int32, half the
+               memory of float64).  Counts go straight into it.
+    * check_bounds -- Skip points off of the screen (default True).
+                      Pass False if the points are known to be on it
+                      (e.g. projected with a screen, which culls them)
+                      to save that pass; points off of it then give
+                      wrong counts or an error.
+    """
+    def __init__(self, dtype=np.int32, check_bounds=True):
+        self.dtype = np.dtype(dtype)
+        self.check_bounds = check_bounds
 
-        dense = np.histogram2d(sparse[:, 1], sparse[:, 0],
-                               bins=(screen[1], screen[0]),
-                               range=((0, screen[1]), (0, screen[0])))
-        return dense[0]
+    def aggregate(self, glyphset, info, screen, out=None):
+        (width, height) = screen
+        if (out is not None and out.shape == (height, width)
+                and out.dtype == self.dtype and out.flags.c_contiguous):
+            dense = out
+            dense.fill(0)
+        else:
+            dense = np.zeros((height, width), dtype=self.dtype)
+
+        # The kernel projects like transform.cpp (truncating toward zero),
+        # which is what points() holds for any other transform.  Under the
+        # identity, points() are the raw coordinates, which pixel_index
+        # floors, so those are counted below.
+        if (isinstance(glyphset, Glyphset)
+                and not is_identity_transform(glyphset.vt)):
+            points = np.asarray(glyphset.viewPoints())
+            if fast_aggregate.project_scatter(dense, points[:, 0],
+                                              points[:, 1], glyphset.vt):
+                return dense
+
+        (pixels, _) = pixel_index(glyphset.points(), screen,
+                                  self.check_bounds)
+        ar.scatter_add(dense, pixels)
+        return dense
 
     def rollup(self, *vals):
         return reduce(lambda x, y: x+y,  vals)
 
 
-# TODO: IS there a faster option for the coder?  'vectorize' is only
-#       a little better than a list comprehension
+def pixel_index(points, screen, check_bounds=True):
+    """
+    Row-major grid positions (y * width + x) of projected points.
+
+    Float coordinates are floored first.  Returns (positions, kept),
+    where kept holds the indices of the points that are on the screen
+    (None when all of them are, or bounds are not checked).
+
+    * points -- Projected points (N x 4, or at least x and y columns)
+    * screen -- (width, height) of the grid
+    * check_bounds -- Leave out points off of the screen (default True).
+                      Without the check, such points get positions that
+                      are out of range or in the wrong cell.
+    """
+    (width, height) = screen
+    (x, y) = (points[:, 0], points[:, 1])
+    if x.dtype.kind == "f":
+        (x, y) = (np.floor(x).astype(np.intp), np.floor(y).astype(np.intp))
+
+    kept = None
+    if check_bounds:
+        keep = (x >= 0) & (x < width) & (y >= 0) & (y < height)
+        if not keep.all():
+            kept = np.flatnonzero(keep)
+            (x, y) = (x[kept], y[kept])
+
+    pixels = y.astype(np.intp)
+    pixels *= width
+    pixels += x
+    return (pixels, kept)
+
+
 class PointCountCategories(ar.Aggregator):
-    def aggregate(self, glyphset, info, screen):
-        points = glyphset.points()
-        coder = np.vectorize(info)
-        coded = coder(glyphset.data())
-        coded = np.array(coded)
-        cats = coded.max()
+    """Count the points of each category that fall into each grid element.
+
+    Info values are integer category codes (see infos.encode); the
+    result has one plane per code, (height, width, categories).  With
+    info None, the glyphset's data is taken to be the codes already.
+    Counting is one scatter over composite (pixel, code) keys, straight
+    into the counts grid (see core.scatter_add).
+
+    * cats -- Number of categories.  Default is one more than the
+              largest code seen.  Codes outside [0, cats) are skipped.
+    * dtype -- Type of the counts grid (default np.int32, as PointCount)
+    * check_bounds -- Skip points off of the screen (see PointCount)
+    """
+    def __init__(self, cats=None, dtype=np.int32, check_bounds=True):
+        self.cats = cats
+        self.dtype = np.dtype(dtype)
+        self.check_bounds = check_bounds
 
+    def aggregate(self, glyphset, info, screen, out=None):
+        points = glyphset.points()
+        if info is None:
+            coded = glyphset.data()
+        else:
+            coded = infos.evaluate(info, glyphset.data(), len(points))
+        coded = np.asarray(coded)
         (width, height) = screen
-        dims = (height, width, cats+1)
+        if self.cats is not None:
+            cats = self.cats
+        elif len(coded) == 0:
+            cats = 0
+        else:
+            cats = max(int(coded.max()) + 1, 0)
+
+        (pixels, kept) = pixel_index(points, screen, self.check_bounds)
+        if kept is not None:
+            coded = coded[kept]
+        valid = (coded >= 0) & (coded < cats)
+        if not valid.all():
+            (pixels, coded) = (pixels[valid], coded[valid])
+
+        pixels *= cats
+        pixels += coded.astype(np.intp, copy=False)
+        shape = (height, width, cats)
+        if (out is not None and out.shape == shape
+                and out.dtype == self.dtype and out.flags.c_contiguous):
+            counts = out
+            counts.fill(0)
+        else:
+            counts = np.zeros(shape, dtype=self.dtype)
+        ar.scatter_add(counts, pixels)
+        return counts
+
+    def rollup(self, *vals):
+        """Categories are info codes, so the same code is the same plane
+           in every set of aggregates.  Sets with fewer planes are
+           treated as having zero counts in the missing ones."""
+        depth = max(v.shape[2] for v in vals)
+        total = np.zeros(vals[0].shape[:2] + (depth,),
+                         dtype=np.result_type(*vals))
+        for v in vals:
+            total[:, :, :v.shape[2]] += v
+        return total
+
+
+class PointMoments(ar.Aggregator):
+    """Count, mean and M2 (sum of squared deviations from the mean) of
+    the info values of the points in each grid element: planes 0, 1 and
+    2 of a (height, width, 3) float64 grid.  Shade with Mean, Variance
+    or Std.
+
+    Moments are accumulated with Welford's method and parts are merged
+    with Chan et al.'s formula, so values far from zero (timestamps, for
+    example) keep their variance, which a sum of squares would lose.
+
+    Points are located once (see pixel_index), then folded into the
+    moments in one pass by a native kernel (see
+    fast_aggregate.scatter_moments).  Without the kernels, moments
+    take three bincount passes (counts and sums, then squared
+    deviations from the means).
+
+    * check_bounds -- Skip points off of the screen (see PointCount)
+    """
+    out_type = np.float64
 
-        # Need cats+1 to do proper categorization...
-        ranges = ((0, screen[1]), (0, screen[0]), (0, cats+1))
+    def __init__(self, check_bounds=True):
+        self.check_bounds = check_bounds
 
-        data = np.hstack([np.fliplr(points[:, 0:2]), coded[:, np.newaxis]])
-        dense = np.histogramdd(data, bins=dims, range=ranges)
-        return dense[0]
+    def aggregate(self, glyphset, info, screen, out=None):
+        points = glyphset.points()
+        vals = infos.evaluate(info, glyphset.data(), len(points))
+        vals = np.asarray(vals, dtype=np.float64)
+        (width, height) = screen
+        (pixels, kept) = pixel_index(points, screen, self.check_bounds)
+        if kept is not None:
+            vals = vals[kept]
+
+        if (out is not None and out.shape == (height, width, 3)
+                and out.dtype == self.out_type and out.flags.c_contiguous):
+            moments = out
+            moments.fill(0)
+        else:
+            moments = np.zeros((height, width, 3), dtype=self.out_type)
+        if fast_aggregate.scatter_moments(moments, pixels, vals):
+            return moments
+
+        size = width * height
+        count = np.bincount(pixels, minlength=size)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean = np.bincount(pixels, vals, minlength=size) / count
+        mean[count == 0] = 0
+        deviations = vals - mean[pixels]
+        deviations *= deviations
+        m2 = np.bincount(pixels, deviations, minlength=size)
+        for (plane, values) in enumerate([count, mean, m2]):
+            moments[:, :, plane] = values.reshape((height, width))
+        return moments
 
     def rollup(self, *vals):
-        """NOTE: Assumes co-registration of categories..."""
-        return reduce(lambda x, y: x+y,  vals)
+        """Merge moments of parts (Chan et al.), into a new grid."""
+        total = vals[0].copy()
+        for part in vals[1:]:
+            (na, nb) = (total[:, :, 0], part[:, :, 0])
+            n = na + nb
+            with np.errstate(divide="ignore", invalid="ignore"):
+                weight = np.where(n > 0, nb / n, 0)
+            delta = part[:, :, 1] - total[:, :, 1]
+            total[:, :, 2] += part[:, :, 2] + delta * delta * na * weight
+            total[:, :, 1] += delta * weight
+            total[:, :, 0] = n
+        return total
+
+
+class Mean(ar.CellShader):
+    """Mean info value per cell, from PointMoments aggregates.
+
+    * empty -- Value for cells without points (default is np.nan)
+    """
+    def __init__(self, empty=np.nan):
+        self.empty = empty
+
+    def shade(self, grid):
+        mean = grid[:, :, 1].copy()
+        mean[grid[:, :, 0] == 0] = self.empty
+        return mean
+
+
+class Variance(ar.CellShader):
+    """Variance of the info values per cell, from PointMoments aggregates.
+
+    * ddof -- Delta degrees of freedom: the divisor is count - ddof
+              (default 0, the population variance; 1 for the sample one)
+    * empty -- Value for cells with count <= ddof (default is np.nan)
+    """
+    def __init__(self, ddof=0, empty=np.nan):
+        self.ddof = ddof
+        self.empty = empty
+
+    def shade(self, grid):
+        (count, m2) = (grid[:, :, 0], grid[:, :, 2])
+        with np.errstate(divide="ignore", invalid="ignore"):
+            variance = m2 / (count - self.ddof)
+        variance[count <= self.ddof] = self.empty
+        return variance
+
+
+class Std(Variance):
+    """Standard deviation of the info values per cell, from PointMoments
+    aggregates (see Variance for the arguments)."""
+    def shade(self, grid):
+        return np.sqrt(Variance.shade(self, grid))
 
 
 class Spread(ar.CellShader):
@@ -184,8 +597,11 @@ class Spread(ar.CellShader):
 
 class Log10(ar.CellShader):
     def shade(self, grid):
+        return self.shadeInto(grid, None)
+
+    def shadeInto(self, grid, out):
         mask = (grid == 0)
-        out = np.log10(grid)
+        out = ar.ufunc_into(np.log10, out, grid)
         out[mask] = 0
         return out
 
@@ -194,12 +610,15 @@ def is_identity_transform(vt):
     return vt == (0, 0, 1, 1)
 
 
-def load_csv(filename, skip, xc, yc, vc):
+def load_csv(filename, skip, xc, yc, vc, dtype=np.float64):
     """Turn a csv file into a glyphset.
 
     This is a fairly naive regulary-expression based parser
     (it doesn't handle quotes, blank lines or much else).
     It is useful for getting simple datasets into the system.
+
+    dtype: Floating point type of the points, np.float64 (default) or
+           np.float32 (half the memory; see fast_project for precision)
     """
     import re
     source = open(filename, 'r')
@@ -219,10 +638,11 @@ def load_csv(filename, skip, xc, yc, vc):
         data.append(v)
 
     source.close()
-    return Glyphset(np.array(points, order="F"), np.array(data))
+    points = np.array(points, dtype=dtype, order="F").reshape((-1, 4))
+    return Glyphset(points, np.array(data))
 
 
-def load_hdf(filename, node, xc, yc, vc=None):
+def load_hdf(filename, node, xc, yc, vc=None, dtype=np.float64):
     """
     Load a node from an HDF file.
 
@@ -235,12 +655,14 @@ def load_hdf(filename, node, xc, yc, vc=None):
         If cats is an empty list, a coding will be automatically generated
         Any value not on the list will be assigned category equal to
         list length. This parameter is ignored if vc is not supplied.
+    dtype: Floating point type of the points, np.float64 (default) or
+           np.float32 (half the memory; see fast_project for precision)
     """
     import pandas as pd
     table = pd.read_hdf(filename, node)
-    points = table[[xc, yc]]
-    a = np.zeros((len(points), 4), order="F")
-    a[:, :2] = points
+    a = np.zeros((len(table), 4), dtype=dtype, order="F")
+    a[:, 0] = table[xc]
+    a[:, 1] = table[yc]
 
     data = table[vc] if vc else None
     print("Loaded %d items" % len(a))
@@ -3,6 +3,8 @@ from six.moves import reduce
 
 import unittest
 import abstract_rendering.categories as categories
+import abstract_rendering.glyphset as glyphset
+import abstract_rendering.infos as infos
 from abstract_rendering.glyphset import ShapeCodes
 from abstract_rendering.util import Color
 import numpy as np
@@ -75,6 +77,23 @@ class CountCategories(unittest.TestCase):
         self.assertEqual(existing.shape, expected.shape)
         self.assertTrue(np.array_equal(existing, expected))
 
+    def test_aggregate(self):
+        points = np.array([[0, 0, 1, 1],
+                           [2, 1, 4, 3],
+                           [1, 0, 3, 2],
+                           [3, 2, 9, 9]], dtype=np.int32)
+        data = ["a", "b", "a", "c"]
+        glyphs = glyphset.Glyphset(points, data,
+                                   glyphset.Literals(ShapeCodes.RECT))
+        op = categories.CountCategories(cats=["a", "b", "d"])
+        out = op.aggregate(glyphs, infos.val(), (4, 3))
+
+        expected = np.zeros((3, 4, 3), dtype=np.int32)
+        expected[0, 0, 0] = 1
+        expected[0:2, 1:3, 0] += 1
+        expected[1:3, 2:4, 1] += 1
+        self.assertTrue(np.array_equal(out, expected))
+
     def test_rollup(self):
         op = categories.CountCategories()
         (width, height, depth) = (8, 5, 3)
@@ -3,8 +3,21 @@ from __future__ import print_function
 import unittest
 import abstract_rendering.core as core
 import abstract_rendering.numeric as numeric
+import abstract_rendering.numpyglyphs as npg
+import abstract_rendering.categories as categories
+import abstract_rendering.general as general
+import abstract_rendering.glyphset as glyphset
+import abstract_rendering.infos as infos
 import numpy as np
 
+
+def _points(n=200, seed=0):
+    rng = np.random.RandomState(seed)
+    points = np.zeros((n, 4), order="F")
+    points[:, 0] = rng.uniform(0, 10, n)
+    points[:, 1] = rng.uniform(0, 5, n)
+    return (points, rng.randint(0, 3, n))
+
 class Seq(unittest.TestCase):
     def test_extend(self):
         op1 = numeric.Cuberoot()
@@ -30,5 +43,354 @@ class Seq(unittest.TestCase):
         self.assertEquals(rslt, op2(op1(start)))
 
 
+class RenderStream(unittest.TestCase):
+    screen = (20, 10)
+    vt = (0, 0, 2, 2)
+
+    def _chunks(self, points, data, size):
+        for start in range(0, len(points), size):
+            yield npg.Glyphset(points[start:start+size],
+                               data[start:start+size])
+
+    def test_counts(self):
+        (points, data) = _points()
+        expected = core.render(npg.Glyphset(points, data), infos.val(),
+                               npg.PointCount(), general.Id(),
+                               self.screen, self.vt)
+        out = core.render_stream(self._chunks(points, data, 30), infos.val(),
+                                 npg.PointCount(), general.Id(),
+                                 self.screen, self.vt)
+        self.assertTrue(np.array_equal(out, expected))
+
+    def test_categories(self):
+        (points, data) = _points()
+        op = categories.CountCategories(cats=[0, 1, 2])
+        expected = core.render(npg.Glyphset(points, data), infos.val(),
+                               op, general.Id(), self.screen, self.vt)
+        out = core.render_stream(self._chunks(points, data, 50), infos.val(),
+                                 op, general.Id(), self.screen, self.vt)
+        self.assertTrue(np.array_equal(out, expected))
+
+    def test_empty(self):
+        self.assertRaises(ValueError, core.render_stream, [], infos.val(),
+                          npg.PointCount(), general.Id(),
+                          self.screen, self.vt)
+
+
+class ScatterAdd(unittest.TestCase):
+    def test_counts(self):
+        for dtype in [np.int32, np.int64, np.float64, np.int16]:
+            grid = np.zeros((2, 3), dtype=dtype)
+            core.scatter_add(grid, np.array([0, 4, 4, 5]))
+            expected = np.array([[1, 0, 0], [0, 2, 1]])
+            self.assertTrue(np.array_equal(grid, expected), str(dtype))
+
+    def test_weights(self):
+        for dtype in [np.int32, np.float32, np.float64]:
+            grid = np.ones((2, 3), dtype=dtype)
+            core.scatter_add(grid, np.array([0, 4, 4, 5]), np.array([1, 2, 3, 4]))
+            expected = np.array([[2, 1, 1], [1, 6, 5]])
+            self.assertTrue(np.array_equal(grid, expected), str(dtype))
+
+
+class RenderParallel(unittest.TestCase):
+    screen = (20, 10)
+    vt = (0, 0, 2, 2)
+
+    def _check(self, aggregator, info):
+        (points, data) = _points()
+        glyphs = npg.Glyphset(points, data)
+        expected = core.render(glyphs, info, aggregator, general.Id(),
+                               self.screen, self.vt)
+        for workers in [2, 3, 7]:
+            out = core.render(glyphs, info, aggregator, general.Id(),
+                              self.screen, self.vt, workers=workers)
+            self.assertTrue(np.array_equal(out, expected),
+                            "%s workers" % workers)
+
+    def test_count(self):
+        self._check(numeric.Count(), infos.val())
+
+    def test_sum(self):
+        self._check(numeric.Sum(), infos.val())
+
+    def test_categories(self):
+        self._check(categories.CountCategories(cats=[0, 1, 2]), infos.val())
+
+    def test_ufunc(self):
+        self._check(numeric.Max(), infos.val())
+        self._check(core.UfuncAggregator(np.bitwise_or, 0, np.int64),
+                    infos.val())
+
+    def test_processes(self):
+        (points, data) = _points()
+        glyphs = npg.Glyphset(points, data)
+        expected = core.render(glyphs, infos.val(), numeric.Sum(), general.Id(),
+                               self.screen, self.vt)
+        out = core.render(glyphs, infos.val(), numeric.Sum(), general.Id(),
+                          self.screen, self.vt, workers=3, backend="processes")
+        self.assertTrue(np.array_equal(out, expected))
+
+        glyphs = npg.Glyphset(points, list(data))
+        out = core.render(glyphs, infos.val(), numeric.Sum(), general.Id(),
+                          self.screen, self.vt, workers=2, backend="processes")
+        self.assertTrue(np.array_equal(out, expected))
+
+    def test_processes_ufunc(self):
+        "Partials come back read-only; rollup must not write into them"
+        (points, data) = _points()
+        glyphs = npg.Glyphset(points, data)
+        for aggregator in [numeric.Max(), numeric.Min(),
+                           numeric.CountDistinct()]:
+            expected = core.render(glyphs, infos.val(), aggregator,
+                                   general.Id(), self.screen, self.vt)
+            out = core.render(glyphs, infos.val(), aggregator, general.Id(),
+                              self.screen, self.vt, workers=3,
+                              backend="processes")
+            self.assertTrue(np.array_equal(out, expected),
+                            type(aggregator).__name__)
+
+    def test_partition(self):
+        (points, data) = _points(10)
+        parts = npg.Glyphset(points, data).partition(3)
+        self.assertEquals([3, 3, 4], [len(p.points()) for p in parts])
+        self.assertTrue(np.array_equal(data, np.hstack([p.data() for p in parts])))
+
+
+class RenderIndexed(unittest.TestCase):
+    screen = (23, 11)
+
+    def test_points(self):
+        (points, data) = _points()
+        glyphs = npg.Glyphset(points, data)
+        indexed = npg.Glyphset(points, data).buildIndex(bins=4)
+        for vt in [(0, 0, 1, 1), (-5, -2, 3, 4), (-100, -100, 1, 1)]:
+            for aggregator in [numeric.Count(), npg.PointCount()]:
+                expected = core.render(glyphs, infos.val(), aggregator,
+                                       general.Id(), self.screen, vt)
+                out = core.render(indexed, infos.val(), aggregator,
+                                  general.Id(), self.screen, vt)
+                self.assertTrue(np.array_equal(out, expected), "%s" % (vt,))
+
+    def test_project(self):
+        (points, data) = _points()
+        indexed = npg.Glyphset(points, data).buildIndex(bins=4)
+        vt = (-5, -2, 3, 4)
+        projected = indexed.project(vt, self.screen)
+        self.assertLess(len(projected.points()), len(points))
+        self.assertEquals(len(projected.points()), len(projected.data()))
+        self.assertEquals(len(indexed.project(vt).points()), len(points))
+
+
+class RenderCulled(unittest.TestCase):
+    screen = (23, 11)
+
+    def test_cull(self):
+        (points, data) = _points()
+        glyphs = npg.Glyphset(points, data)
+        for vt in [(0, 0, 1, 1), (-5, -2, 3, 4), (-100, -100, 1, 1)]:
+            full = glyphs.project(vt)
+            culled = glyphs.project(vt, self.screen)
+            (x, y) = (full.points()[:, 0], full.points()[:, 1])
+            visible = ((x >= 0) & (x < self.screen[0]) &
+                       (y >= 0) & (y < self.screen[1]))
+            self.assertEquals(len(culled.points()), visible.sum())
+            self.assertEquals(culled.culled, len(points) - visible.sum())
+            self.assertTrue(np.array_equal(culled.data(), data[visible]))
+
+            expected = numeric.Count().aggregate(full, infos.val(),
+                                                 self.screen)
+            out = numeric.Count().aggregate(culled, infos.val(), self.screen)
+            self.assertTrue(np.array_equal(out, expected), "%s" % (vt,))
+
+
+class RenderContextTests(unittest.TestCase):
+    screen = (23, 11)
+    vts = [(0, 0, 2, 2), (-3, -1, 2.5, 2.5), (1, 1, 1.5, 2)]
+
+    def _frames(self, glyphs, aggregator, shader):
+        context = core.RenderContext()
+        for vt in self.vts:
+            expected = core.render(glyphs, infos.val(), aggregator, shader,
+                                   self.screen, vt)
+            out = core.render(glyphs, infos.val(), aggregator, shader,
+                              self.screen, vt, context=context)
+            self.assertTrue(np.array_equal(out, expected), "%s" % (vt,))
+            yield (context, out)
+
+    def test_reuse(self):
+        (points, data) = _points()
+        glyphs = npg.Glyphset(points, data)
+        shader = numeric.Sqrt() + numeric.Floor()
+        frames = self._frames(glyphs, numeric.Count(), shader)
+        (context, out) = next(frames)
+        buffers = (context.projected, context.aggregates, out)
+        for (context, out) in frames:
+            self.assertIs(context.projected, buffers[0])
+            self.assertIs(context.aggregates, buffers[1])
+            self.assertIs(out, buffers[2])
+
+    def test_indexed(self):
+        (points, data) = _points()
+        glyphs = npg.Glyphset(points, data).buildIndex(bins=4)
+        for aggregator in [numeric.Count(), npg.PointCount()]:
+            for (context, out) in self._frames(glyphs, aggregator,
+                                               npg.Log10()):
+                pass
+
+    def test_old_aggregator(self):
+        "Aggregators written before out= still render with a context"
+        class Count(numeric.Count):
+            def aggregate(self, glyphset, info, screen):
+                return numeric.Count.aggregate(self, glyphset, info, screen)
+
+        (points, data) = _points()
+        glyphs = npg.Glyphset(points, data)
+        for (context, out) in self._frames(glyphs, Count(), general.Id()):
+            pass
+
+    def test_mismatch(self):
+        (points, data) = _points()
+        glyphs = npg.Glyphset(points, data)
+        context = core.RenderContext()
+        core.render(glyphs, infos.val(), numeric.Count(), general.Id(),
+                    self.screen, self.vts[0], context=context)
+        out = core.render(glyphs, infos.val(), numeric.Count(), general.Id(),
+                          (5, 4), self.vts[0], context=context)
+        self.assertEquals(out.shape, (4, 5))
+
+
+class RenderPan(unittest.TestCase):
+    screen = (23, 11)
+    pans = [(2, 1), (3, 0), (-5, -2), (0, 4), (-1, 0), (22, -10), (0, 0)]
+
+    def _glyphs(self):
+        (points, data) = _points(400)
+        points[:, :2] -= 2  # Some points project to negative pixels
+        return (points, data)
+
+    def _check(self, glyphs, aggregator, shader=None):
+        shader = general.Id() if shader is None else shader
+        context = core.RenderContext()
+        info = infos.val()  # The same info, or frames are not pans
+        vt = [1, 2, 2.5, 2]
+        core.render_pan(glyphs, info, aggregator, shader,
+                        self.screen, tuple(vt), context)
+        for (dx, dy) in self.pans:
+            vt[0] += dx
+            vt[1] += dy
+            expected = core.render(glyphs, info, aggregator, shader,
+                                   self.screen, tuple(vt))
+            out = core.render_pan(glyphs, info, aggregator, shader,
+                                  self.screen, tuple(vt), context)
+            self.assertTrue(np.allclose(out, expected), "vt %s" % (vt,))
+
+    def test_count(self):
+        (points, data) = self._glyphs()
+        self._check(npg.Glyphset(points, data), numeric.Count())
+        self._check(npg.Glyphset(points, data), npg.PointCount())
+
+    def test_sum(self):
+        (points, data) = self._glyphs()
+        self._check(npg.Glyphset(points, data), numeric.Sum(), npg.Log10())
+
+    def test_indexed(self):
+        (points, data) = self._glyphs()
+        self._check(npg.Glyphset(points, data).buildIndex(bins=5),
+                    numeric.Sum())
+        rects = points.copy(order="F")
+        rects[:, 2:] = 0.7
+        glyphs = glyphset.Glyphset(rects, data,
+                                   glyphset.Literals(glyphset.ShapeCodes.RECT))
+        self._check(glyphs.buildIndex(bins=5), numeric.Count())
+
+    def test_lines(self):
+        "Pans of lines that cross negative pixels match a full render"
+        rng = np.random.RandomState(0)
+        lines = np.zeros((400, 4), order="F")
+        lines[:, 0::2] = rng.uniform(-6, 10, (400, 2))
+        lines[:, 1::2] = rng.uniform(-6, 8, (400, 2))
+        data = np.ones(400)
+        glyphs = glyphset.Glyphset(lines, data,
+                                   glyphset.Literals(glyphset.ShapeCodes.LINE))
+        self._check(glyphs, numeric.Count())
+
+    def test_full_render(self):
+        (points, data) = self._glyphs()
+        glyphs = npg.Glyphset(points, data)
+        context = core.RenderContext()
+        vt = (1, 2, 2.5, 2)
+        core.render_pan(glyphs, infos.val(), numeric.Count(), general.Id(),
+                        self.screen, vt, context)
+        self.assertEquals(context.panShift(glyphs, infos.val(),
+                                           numeric.Count(), self.screen, vt),
+                          None)  # Different info/aggregator objects
+        (info, aggregator) = context.frame[1:3]
+        for (nvt, shift) in [((3, 1, 2.5, 2), (2, -1)),
+                             ((3.5, 1, 2.5, 2), None),
+                             ((1, 2, 3, 2), None),
+                             ((40, 2, 2.5, 2), None)]:
+            self.assertEquals(context.panShift(glyphs, info, aggregator,
+                                               self.screen, nvt),
+                              shift, "vt %s" % (nvt,))
+
+
+class RenderTiled(unittest.TestCase):
+    screen = (23, 11)
+    vt = (0, 0, 2.3, 2.2)
+
+    def _check(self, glyphs, aggregator, info, workers=None, vt=None):
+        vt = self.vt if vt is None else vt
+        expected = core.render(glyphs, info, aggregator, general.Id(),
+                               self.screen, vt)
+        for tile in [(5, 4), (8, 8), (30, 30)]:
+            out = core.render(glyphs, info, aggregator, general.Id(),
+                              self.screen, vt, tile=tile, workers=workers)
+            self.assertEquals(out.shape, expected.shape)
+            self.assertTrue(np.array_equal(out, expected), "Tile %s" % (tile,))
+
+    def test_points(self):
+        (points, data) = _points()
+        glyphs = npg.Glyphset(points, data)
+        self._check(glyphs, numeric.Count(), infos.val())
+        self._check(glyphs, npg.PointCount(), infos.val(), workers=3)
+        self._check(glyphs, npg.PointCountCategories(), infos.val())
+
+    def test_identity(self):
+        "Unprojected float points (identity vt) land in their tiles"
+        (points, data) = _points(500)
+        glyphs = npg.Glyphset(points, None)
+        self._check(glyphs, npg.PointCount(), None, vt=(0, 0, 1, 1))
+        out = core.render(glyphs, None, npg.PointCount(), general.Id(),
+                          self.screen, (0, 0, 1, 1), tile=(5, 4))
+        self.assertEquals(out.sum(), 500)
+
+    def test_rects(self):
+        (points, data) = _points()
+        points[:, 2:] = 1.5
+        glyphs = npg.Glyphset(points, data, self.vt)
+        projected = glyphs.points().copy()
+        projected[:, 2:] += (points[:, 2:] * 2).astype(np.int32)
+        rects = glyphset.Glyphset(projected, data,
+                                  glyphset.Literals(glyphset.ShapeCodes.RECT))
+
+        expected = numeric.Sum().aggregate(rects, infos.val(), self.screen)
+        out = core.aggregate_tiled(rects, infos.val(), numeric.Sum(),
+                                   self.screen, (6, 5))
+        self.assertTrue(np.array_equal(out, expected))
+
+    def test_lines(self):
+        (points, data) = _points()
+        lines = npg.Glyphset(points, data, self.vt).points().copy()
+        lines[:, 2:] = lines[::-1, :2]
+        lines = glyphset.Glyphset(lines, data,
+                                  glyphset.Literals(glyphset.ShapeCodes.LINE))
+
+        expected = numeric.Count().aggregate(lines, infos.val(), self.screen)
+        out = core.aggregate_tiled(lines, infos.val(), numeric.Count(),
+                                   self.screen, (6, 5), workers=2)
+        self.assertTrue(np.array_equal(out, expected))
+
+
 if __name__ == '__main__':
     unittest.main()
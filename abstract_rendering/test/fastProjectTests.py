@@ -0,0 +1,113 @@
+from __future__ import print_function, division, absolute_import
+import numpy as np
+import unittest
+import abstract_rendering.fast_project as fast_project
+
+
+class ProjectRectsGeneratorTests(unittest.TestCase):
+    vt = (3.0, -4.0, 2.5, 1.5)
+
+    def _inputs(self, n=1013, dtype=np.float64):
+        rng = np.random.RandomState(3)
+        return (rng.uniform(-50, 50, size=(4, n))).astype(dtype)
+
+    def _check(self, inputs, chunk_size, use_dispatch):
+        expected = np.empty(inputs.shape, dtype=np.int32)
+        fast_project._projectRects(self.vt, inputs, expected)
+
+        chunks = [chunk.copy() for chunk in
+                  fast_project._projectRectsGenerator(self.vt, inputs,
+                                                      chunk_size,
+                                                      use_dispatch)]
+        self.assertTrue(all(c.shape[1] <= chunk_size for c in chunks))
+        self.assertTrue(np.array_equal(np.hstack(chunks), expected),
+                        "chunk %d, dispatch %s" % (chunk_size, use_dispatch))
+
+    def test_chunks(self):
+        for use_dispatch in [False, True]:
+            for chunk_size in [1, 100, 1013, 5000]:
+                self._check(self._inputs(), chunk_size, use_dispatch)
+
+    def test_float(self):
+        self._check(self._inputs(dtype=np.float32), 100, True)
+
+    def test_column_major(self):
+        rows = np.asfortranarray(self._inputs().T)
+        expected = np.empty(rows.shape, dtype=np.int32, order="F")
+        fast_project._projectRects(self.vt, rows, expected)
+        chunks = list(chunk.copy() for chunk in
+                      fast_project._projectRectsGenerator(self.vt, rows, 300))
+        self.assertTrue(np.array_equal(np.hstack(chunks), expected.T))
+
+    def test_empty(self):
+        chunks = fast_project._projectRectsGenerator(self.vt,
+                                                     np.zeros((4, 0)), 10)
+        self.assertEquals(list(chunks), [])
+
+    def test_threads(self):
+        if fast_project._lib_threads is None:
+            self.skipTest("Threaded projection library not built")
+        inputs = self._inputs(n=200003)
+        expected = np.empty(inputs.shape, dtype=np.int32)
+        out = np.empty(inputs.shape, dtype=np.int32)
+        fast_project._projectRects(self.vt, inputs, out)
+
+        default = fast_project._lib_default
+        fast_project._lib_default = fast_project._lib
+        try:
+            fast_project._projectRects(self.vt, inputs, expected)
+        finally:
+            fast_project._lib_default = default
+        self.assertTrue(np.array_equal(out, expected))
+
+
+class ProjectorTests(unittest.TestCase):
+    vt = (3.0, -4.0, 2.5, 1.5)
+
+    def _expected(self, inputs):
+        expected = np.empty_like(inputs, dtype=np.int32)
+        fast_project._projectRects(self.vt, inputs, expected)
+        return expected
+
+    def test_ranges(self):
+        inputs = np.random.RandomState(0).uniform(-9, 9, size=(4, 500))
+        expected = self._expected(inputs)
+        outputs = np.zeros((4, 100), dtype=np.int32)
+        project = fast_project.Projector(inputs, outputs)
+        for offset in [0, 150, 400]:
+            project(self.vt, offset, 100)
+            self.assertTrue(np.array_equal(outputs,
+                                           expected[:, offset:offset+100]))
+
+        project(self.vt, 480)
+        self.assertTrue(np.array_equal(outputs[:, :20], expected[:, 480:]))
+
+    def test_reuse(self):
+        inputs = np.asfortranarray(np.random.RandomState(0).uniform(-9, 9, size=(50, 4)))
+        outputs = np.empty((50, 4), dtype=np.int32, order="F")
+        project = fast_project.Projector(inputs, outputs)
+        project(self.vt)
+        self.assertTrue(np.array_equal(outputs, self._expected(inputs)))
+
+        inputs *= 2
+        project(self.vt)
+        self.assertTrue(np.array_equal(outputs, self._expected(inputs)))
+
+    def test_validation(self):
+        inputs = np.zeros((4, 10))
+        Projector = fast_project.Projector
+        self.assertRaises(TypeError, Projector, inputs.astype(np.int64),
+                          np.zeros((4, 10), dtype=np.int32))
+        self.assertRaises(ValueError, Projector, inputs,
+                          np.zeros((4, 10), dtype=np.int64))
+        self.assertRaises(ValueError, Projector, np.zeros((3, 10)),
+                          np.zeros((3, 10), dtype=np.int32))
+
+        project = Projector(inputs, np.zeros((4, 5), dtype=np.int32))
+        self.assertRaises(ValueError, project, self.vt)
+        self.assertRaises(ValueError, project, self.vt, 8, 5)
+        project(self.vt, 5, 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
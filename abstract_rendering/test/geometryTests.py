@@ -87,5 +87,137 @@ class BressenhamTests(unittest.TestCase):
         self.assertTrue(np.array_equal(out, expected), "Complex value")
 
 
+class RectPixelsTests(unittest.TestCase):
+    def test_points(self):
+        rects = np.array([[0, 0, 1, 1], [2, 1, 3, 2], [2, 1, 3, 2]])
+        (glyphs, pixels) = geometry.rect_pixels(rects, (4, 3))
+        self.assertTrue(np.array_equal(glyphs, [0, 1, 2]))
+        self.assertTrue(np.array_equal(pixels, [0, 6, 6]))
+
+    def test_rects(self):
+        rects = np.array([[1, 0, 3, 2], [0, 2, 1, 3]])
+        (glyphs, pixels) = geometry.rect_pixels(rects, (4, 3))
+        self.assertTrue(np.array_equal(glyphs, [0, 0, 0, 0, 1]))
+        self.assertTrue(np.array_equal(pixels, [1, 2, 5, 6, 8]))
+
+    def test_clipped(self):
+        rects = np.array([[-2, -1, 1, 1], [3, 2, 9, 9], [5, 5, 6, 6]])
+        (glyphs, pixels) = geometry.rect_pixels(rects, (4, 3))
+        self.assertTrue(np.array_equal(glyphs, [0, 1]))
+        self.assertTrue(np.array_equal(pixels, [0, 11]))
+
+
+class CullTests(unittest.TestCase):
+    def test_rects(self):
+        rects = np.array([[-2, -1, 1, 1], [3, 2, 9, 9], [5, 5, 6, 6],
+                          [1, 1, 2, 2], [-3, 0, 0, 2]])
+        (kept, positions) = geometry.cull(rects, 2, (4, 3))
+        self.assertTrue(np.array_equal(positions, [0, 1, 3]))
+        self.assertTrue(np.array_equal(kept, [[0, 0, 1, 1],
+                                              [3, 2, 4, 3],
+                                              [1, 1, 2, 2]]))
+        self.assertTrue(np.array_equal(rects[0], [-2, -1, 1, 1]),
+                        "Input unchanged")
+
+    def test_unchanged(self):
+        rects = np.array([[0, 0, 1, 1], [3, 2, 4, 3]])
+        (kept, positions) = geometry.cull(rects, 0, (4, 3))
+        self.assertIs(kept, rects)
+        self.assertTrue(np.array_equal(positions, [0, 1]))
+
+    def test_lines(self):
+        lines = np.array([[-5, 1, 9, 1], [-5, -5, -1, -1], [2, 2, 2, 8]])
+        (kept, positions) = geometry.cull(lines, 1, (4, 3))
+        self.assertTrue(np.array_equal(positions, [0, 2]))
+        self.assertTrue(np.array_equal(kept, lines[[0, 2]]))
+
+    def test_empty(self):
+        (kept, positions) = geometry.cull(np.zeros((0, 4)), 2, (4, 3))
+        self.assertEquals(len(kept), 0)
+        self.assertEquals(len(positions), 0)
+
+
+class RectCoverageTests(unittest.TestCase):
+    def test_counts(self):
+        rects = np.array([[0, 0, 3, 2], [1, 1, 9, 3], [-4, -4, -1, -1]])
+        out = geometry.rect_coverage(rects, (4, 3))
+        expected = np.array([[1, 1, 1, 0],
+                             [1, 2, 2, 1],
+                             [0, 1, 1, 1]])
+        self.assertTrue(np.array_equal(out, expected))
+
+    def test_weights(self):
+        rects = np.array([[0, 0, 3, 2], [1, 1, 9, 3], [-4, -4, -1, -1]])
+        out = geometry.rect_coverage(rects, (4, 3), [2, 5, 7])
+        expected = np.array([[2, 2, 2, 0],
+                             [2, 7, 7, 5],
+                             [0, 5, 5, 5]])
+        self.assertTrue(np.array_equal(out, expected))
+
+
+class LinePixelsTests(unittest.TestCase):
+    def _draw(self, lines, screen):
+        (width, height) = screen
+        out = np.zeros((height, width), dtype=np.int32)
+        for (_, pixels) in geometry.line_pixels(lines, screen):
+            np.add.at(out.ravel(), pixels, 1)
+        return out
+
+    def test_matches_bressenham(self):
+        lines = [[2, 2, 7, 6], [7, 3, 0, 9], [0, 0, 1, 10]]
+        expected = np.zeros((10, 11), dtype=np.int32)
+        for (x0, y0, x1, y1) in lines:
+            end = [x1 - np.sign(x1-x0), y1 - np.sign(y1-y0)]
+            geometry.bressenham(expected, [x0, y0] + end, 1)
+
+        out = self._draw(lines, (11, 10))
+        self.assertTrue(np.array_equal(out, expected))
+
+    def test_clipped(self):
+        out = self._draw([[-3, 1, 5, 2], [20, 20, 30, 30]], (4, 3))
+        expected = np.array([[0, 0, 0, 0],
+                             [1, 1, 1, 1],
+                             [0, 0, 0, 0]])
+        self.assertTrue(np.array_equal(out, expected))
+
+    def _walk(self, line, screen):
+        "On-screen pixels of the whole (unclipped) Bresenham walk of a line"
+        (width, height) = screen
+        (x0, y0, x1, y1) = line
+        (x1, y1) = (x1 - np.sign(x1-x0), y1 - np.sign(y1-y0))
+        (dx, dy) = (abs(x1-x0), abs(y1-y0))
+        (sx, sy) = (1 if x0 < x1 else -1, 1 if y0 < y1 else -1)
+        err = dx - dy
+        pixels = []
+        while True:
+            if 0 <= x0 < width and 0 <= y0 < height:
+                pixels.append(y0*width + x0)
+            if x0 == x1 and y0 == y1:
+                return pixels
+            e2 = err * 2
+            if e2 > -dy:
+                (err, x0) = (err - dy, x0 + sx)
+            if e2 < dx:
+                (err, y0) = (err + dx, y0 + sy)
+
+    def test_long_clipped(self):
+        "Clipping long lines keeps the pixels of the whole walk"
+        screen = (13, 7)
+        lines = [[-4000, -1000, 3000, 1500], [5000, 6, -3000, 1],
+                 [3, -2000, 9, 3000], [-70, 3, 90, 4], [-50, -50, -10, 2]]
+        batches = list(geometry.line_pixels(lines, screen))
+        self.assertLess(len(batches), 50)
+        for (glyph, line) in enumerate(lines):
+            pixels = np.concatenate([p[g == glyph] for (g, p) in batches])
+            self.assertEqual(sorted(pixels), sorted(self._walk(line, screen)))
+
+        rng = np.random.RandomState(3)
+        lines = rng.randint(-60, 80, (200, 4))
+        batches = list(geometry.line_pixels(lines, screen))
+        for (glyph, line) in enumerate(lines):
+            pixels = np.concatenate([p[g == glyph] for (g, p) in batches])
+            self.assertEqual(sorted(pixels), sorted(self._walk(line, screen)))
+
+
 if __name__ == '__main__':
     unittest.main()
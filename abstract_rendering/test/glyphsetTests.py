@@ -2,6 +2,7 @@ from __future__ import print_function, division, absolute_import
 from six.moves import range
 import numpy as np
 import unittest
+import abstract_rendering.fast_project as fast_project
 import abstract_rendering.glyphset as glyphset
 
 
@@ -78,6 +79,138 @@ class ShaperTests(unittest.TestCase):
         self.assertEquals(f(["ABCDEF"]), [["C", "E", 0, 0]])
 
 
+class SpatialIndexTests(unittest.TestCase):
+    screen = (20, 10)
+    transforms = [(0, 0, 1, 1), (-150, -40, 2.5, 1.5),
+                  (40, 30, -.5, -.25), (-1000, -1000, 1, 1)]
+
+    def _points(self, shapecode):
+        np.random.seed(7)
+        points = np.random.uniform(-50, 150, size=(2000, 4))
+        if shapecode == glyphset.ShapeCodes.POINT:
+            points[:, 2:] = 0
+        elif shapecode == glyphset.ShapeCodes.RECT:
+            points[:, 2:] = np.random.exponential(3, size=(2000, 2))
+        return points
+
+    def _check(self, shapecode, bins=None):
+        points = self._points(shapecode)
+        index = glyphset.SpatialIndex(points, shapecode, bins)
+        (x0, y0, x1, y1) = index._boxes(points, shapecode)
+        for vt in self.transforms:
+            found = index.query(vt, self.screen)
+            self.assertTrue(np.all(np.diff(found) > 0), "Ordered: %s" % (vt,))
+
+            (wx0, wy0, wx1, wy1) = index.window(vt, self.screen)
+            expected = np.flatnonzero((x1 >= wx0) & (x0 <= wx1) &
+                                      (y1 >= wy0) & (y0 <= wy1))
+            self.assertTrue(np.array_equal(found, expected), "%s" % (vt,))
+
+    def test_points(self):
+        self._check(glyphset.ShapeCodes.POINT)
+        self._check(glyphset.ShapeCodes.POINT, bins=1)
+
+    def test_rects(self):
+        self._check(glyphset.ShapeCodes.RECT)
+        self._check(glyphset.ShapeCodes.RECT, bins=50)
+
+    def test_lines(self):
+        self._check(glyphset.ShapeCodes.LINE)
+
+    def test_window(self):
+        index = glyphset.SpatialIndex(self._points(0), 0)
+        (x0, y0, x1, y1) = index.window((-10, 4, 2, .5), self.screen)
+        self.assertTrue(x0 <= 5 and x1 >= 15)
+        self.assertTrue(y0 <= -8 and y1 >= 12)
+
+    def test_nonfinite(self):
+        points = self._points(glyphset.ShapeCodes.POINT)
+        points[::2, 0] = np.nan
+        index = glyphset.SpatialIndex(points, glyphset.ShapeCodes.POINT)
+        found = index.query((0, 0, .01, .01), self.screen)
+        self.assertTrue(np.array_equal(found, np.arange(1, len(points), 2)))
+
+    def test_empty(self):
+        index = glyphset.SpatialIndex(np.zeros((0, 4)), 0)
+        self.assertEquals(len(index.query((0, 0, 1, 1), self.screen)), 0)
+
+
+class ProjectTests(unittest.TestCase):
+    def _glyphs(self, shapecode=glyphset.ShapeCodes.RECT):
+        points = np.array([[0, 0, 0, 0], [1, 1, 2, 0],
+                           [2.5, .5, .2, 3], [30, 1, 1, 1]], dtype=np.float64)
+        return glyphset.Glyphset(np.asfortranarray(points), [1, 2, 3, 4],
+                                 glyphset.Literals(shapecode))
+
+    def test_ensure_visible(self):
+        projected = self._glyphs().project((0, 0, 2, 2))
+        expected = [[0, 0, 1, 1], [2, 2, 6, 3], [5, 1, 6, 7], [60, 2, 62, 4]]
+        self.assertTrue(np.array_equal(projected.points(), expected))
+        self.assertEquals(projected.data(), [1, 2, 3, 4])
+        self.assertEquals(projected.culled, 0)
+
+    def test_screen(self):
+        glyphs = self._glyphs()
+        for g in [glyphs, self._glyphs().buildIndex()]:
+            projected = g.project((0, 0, 2, 2), (6, 5))
+            expected = [[0, 0, 1, 1], [2, 2, 6, 3], [5, 1, 6, 5]]
+            self.assertTrue(np.array_equal(projected.points(), expected))
+            self.assertEquals(list(projected.data()), [1, 2, 3])
+            self.assertEquals(projected.culled, 1)
+
+    def test_option(self):
+        points = np.asfortranarray([[1.0, 1.0, 0.0, .1], [0.0, 0.0, 2.0, 2.0]])
+        out = np.empty_like(points, dtype=np.int32)
+        fast_project._projectRects((0, 0, 1, 1), points, out)
+        self.assertTrue(np.array_equal(out, [[1, 1, 1, 1], [0, 0, 2, 2]]))
+        fast_project._projectRects((0, 0, 1, 1), points, out, ensure_visible=True)
+        self.assertTrue(np.array_equal(out, [[1, 1, 2, 2], [0, 0, 2, 2]]))
+
+
+class LoadTests(unittest.TestCase):
+    def test_load_csv(self):
+        import os
+        import tempfile
+        (fd, path) = tempfile.mkstemp(suffix=".csv")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write("x,y,v\n1.5,2.25,3\n4,5.5,6\n")
+            glyphs = glyphset.load_csv(path, 1, 0, 1, 2, .5, .5,
+                                       glyphset.ShapeCodes.RECT,
+                                       dtype=np.float32)
+        finally:
+            os.remove(path)
+        points = glyphs.points()
+        self.assertEquals(points.dtype, np.float32)
+        self.assertTrue(np.array_equal(points, [[1.5, 2.25, .5, .5],
+                                                [4, 5.5, .5, .5]]))
+        self.assertEquals(glyphs.data(), [3, 6])
+        projected = glyphs.project((0, 0, 2, 2))
+        self.assertTrue(np.array_equal(projected.points(),
+                                       [[3, 4, 4, 5], [8, 11, 9, 12]]))
+
+    def test_load_hdf(self):
+        import pandas as pd
+        table = pd.DataFrame({"x": [1.5, 4], "y": [2.25, 5.5], "v": [3, 6]})
+        read_hdf = pd.read_hdf
+        pd.read_hdf = lambda filename, node: table
+        try:
+            glyphs = glyphset.load_hdf("unused.h5", "node", "x", "y", "v",
+                                       .5, .5, glyphset.ShapeCodes.RECT,
+                                       dtype=np.float32)
+            unvalued = glyphset.load_hdf("unused.h5", "node", "x", "y", None,
+                                         .5, .5, glyphset.ShapeCodes.RECT)
+        finally:
+            pd.read_hdf = read_hdf
+        points = glyphs.points()
+        self.assertEquals(points.dtype, np.float32)
+        self.assertTrue(points.flags.f_contiguous)
+        self.assertTrue(np.array_equal(points, [[1.5, 2.25, .5, .5],
+                                                [4, 5.5, .5, .5]]))
+        self.assertEquals(list(glyphs.data()), [3, 6])
+        self.assertEquals(unvalued.data(), [1, 1])
+
+
 class GlyphsetTests(object):
     def test_bounds(self):
         self.assertTrue(np.array_equal(self._glyphset.bounds(), self._bounds))
@@ -106,5 +239,49 @@ class ColumnGlyphset(GlyphsetTests, unittest.TestCase):
         self._glyphset = glyphset.Glyphset(points, self._data, glyphset.ToPoint(glyphset.item(0), glyphset.item(1)), colMajor=True)
         self._bounds = [0.0, 0.0, 1.0, 1.0]
 
+    def test_cached(self):
+        self.assertIs(self._glyphset.points(), self._glyphset.points())
+
+    def test_shaper(self):
+        "Glyphsets do not change a shaper they share."
+        shaper = self._glyphset.shaper
+        rows = glyphset.Glyphset([[0, 0], [1, 1], [.5, .5]], self._data, shaper)
+        self.assertFalse(shaper.colMajor)
+        self.assertTrue(np.array_equal(rows.points(), self._points))
+        self.assertTrue(np.array_equal(self._glyphset.points(), self._points))
+
+
+class ColumnsGlyphset(GlyphsetTests, unittest.TestCase):
+    def setUp(self):
+        self._data = [1, 2, 3, 4, 5, 6]
+        self._columns = glyphset.Columns([0, 1, .5], [0, 1, .5])
+        self._points = np.array([[0, 0, 0, 0], [1, 1, 0, 0], [.5, .5, 0, 0]])
+        self._glyphset = glyphset.Glyphset(self._columns, self._data, glyphset.Literals(glyphset.ShapeCodes.POINT))
+        self._bounds = [0.0, 0.0, 1.0, 1.0]
+
+    def test_view(self):
+        points = self._glyphset.points()
+        self.assertTrue(np.shares_memory(points, self._columns.x))
+        self.assertTrue(points.flags.f_contiguous)
+        self.assertTrue(self._columns.x.flags.c_contiguous)
+        self.assertEqual(self._columns.x.dtype, np.float64)
+
+    def test_project(self):
+        vt = (1, 2, 3.5, 2)
+        expected = glyphset.Glyphset(self._points.copy(order="F"), self._data,
+                                     glyphset.Literals(glyphset.ShapeCodes.POINT))
+        self.assertTrue(np.array_equal(self._glyphset.project(vt).points(),
+                                       expected.project(vt).points()))
+
+    def test_dtype(self):
+        columns = glyphset.Columns(np.arange(3), np.arange(3), 1, 2)
+        self.assertEqual(columns.points().dtype, np.float64)
+        self.assertEqual(list(columns.h), [2, 2, 2])
+        columns = glyphset.Columns(np.arange(3, dtype=np.float32), [0, 1, 2])
+        self.assertEqual(columns.points().dtype, np.float64)
+        columns = glyphset.Columns(np.arange(3, dtype=np.float32),
+                                   np.arange(3, dtype=np.float32))
+        self.assertEqual(columns.points().dtype, np.float32)
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,6 +1,7 @@
 from __future__ import print_function
 
 import unittest
+import numpy as np
 import abstract_rendering.infos as infos
 
 
@@ -16,6 +17,11 @@ class Const(unittest.TestCase):
         self.assertEqual(3, info(object()))
         self.assertEqual(3, info(self))
 
+    def test_column(self):
+        info = infos.const(3)
+        self.assertTrue(np.array_equal([3, 3, 3], info.column(None, 3)))
+        self.assertTrue(np.array_equal([3, 3], info.column([1, 2], 2)))
+
 
 class Val(unittest.TestCase):
     def test(self):
@@ -26,6 +32,13 @@ class Val(unittest.TestCase):
         self.assertEqual(0, info(0))
         self.assertEqual(15, info(None))
 
+    def test_column(self):
+        info = infos.val(15)
+        out = info.column([3, 0, None], 3)
+        self.assertTrue(np.array_equal([3, 0, 15], out))
+        self.assertTrue(np.issubdtype(out.dtype, np.integer))
+        self.assertTrue(np.array_equal([15, 15], info.column(None, 2)))
+
 
 class ValAt(unittest.TestCase):
     def test(self):
@@ -36,6 +49,15 @@ class ValAt(unittest.TestCase):
         self.assertEqual("three", info(["zero", "one", "two", "three"]))
         self.assertEqual("Nothing", info(None))
 
+    def test_column(self):
+        info = infos.valAt(1, -1)
+        data = np.array([[0, 1, 2], [3, 4, 5]])
+        self.assertTrue(np.array_equal([1, 4], info.column(data, 2)))
+        self.assertTrue(np.array_equal([1, -1], info.column([[0, 1], []], 2)))
+
+        info = infos.valAt(3, -1)
+        self.assertTrue(np.array_equal([-1, -1], info.column(data, 2)))
+
 
 class Key(unittest.TestCase):
     def test(self):
@@ -45,6 +67,16 @@ class Key(unittest.TestCase):
         self.assertEqual(3, info({"val": 3, "other": 6}))
         self.assertEqual("seven", info({"value": 3, "other": 6}))
 
+    def test_column(self):
+        info = infos.key("val", 7)
+        data = np.array([(1, 2.0), (3, 4.0)],
+                        dtype=[("val", int), ("other", float)])
+        self.assertTrue(np.array_equal([1, 3], info.column(data, 2)))
+        self.assertTrue(np.array_equal([1, 3], info.column({"val": [1, 3]}, 2)))
+
+        data = [{"val": 3, "other": 6}, {"other": 6}]
+        self.assertTrue(np.array_equal([3, 7], info.column(data, 2)))
+
 
 class Attribute(unittest.TestCase):
 
@@ -63,6 +95,15 @@ class Attribute(unittest.TestCase):
         self.assertEqual(13, info(self.Has()))
         self.assertEqual("seven", info(self.HasNot()))
 
+    def test_column(self):
+        info = infos.attribute("val", 7)
+        data = np.rec.array([(1, 2.0), (3, 4.0)],
+                            dtype=[("val", int), ("other", float)])
+        self.assertTrue(np.array_equal([1, 3], info.column(data, 2)))
+
+        data = [self.Has(), self.HasNot()]
+        self.assertTrue(np.array_equal([13, 7], info.column(data, 2)))
+
 class Encode(unittest.TestCase):
     def test(self):
         info = infos.encode(["zero", "one", "two"])
@@ -82,6 +123,43 @@ class Encode(unittest.TestCase):
         self.assertEqual(0, info("stuff"))
         self.assertEqual(0, info("more"))
 
+    def test_column(self):
+        info = infos.encode(["zero", "one", "two"])
+        data = np.array(["two", "stuff", "zero", "one", "zzz"])
+        out = info.column(data, len(data))
+        self.assertTrue(np.array_equal([2, 3, 0, 1, 3], out))
+
+        info = infos.encode([30, 10, 20], defcat=0)
+        out = info.column(np.array([10, 20, 30, 40, 5]), 5)
+        self.assertTrue(np.array_equal([1, 2, 0, 0, 0], out))
+
+    def test_duplicates(self):
+        info = infos.encode(["a", "b", "a"])
+        data = ["a", "b", "c", "a"]
+        expected = [info(v) for v in data]
+        self.assertEqual([2, 1, 3, 2], expected)
+        self.assertTrue(np.array_equal(expected,
+                                       info.column(np.array(data), 4)))
+        self.assertTrue(np.array_equal(expected, infos.evaluate(info, data, 4)))
+
+
+class AutoEncode(unittest.TestCase):
+    def test_column(self):
+        info = infos.AutoEncode()
+        self.assertEqual(0, info("b"))
+        out = info.column(np.array(["c", "b", "a", "c"]), 4)
+        self.assertTrue(np.array_equal([1, 0, 2, 1], out))
+        self.assertEqual(3, info("d"))
+
+
+class Evaluate(unittest.TestCase):
+    def test(self):
+        out = infos.evaluate(infos.val(), np.array([1, 2, 3]), 3)
+        self.assertTrue(np.array_equal([1, 2, 3], out))
+
+        out = infos.evaluate(lambda v: v*2, [1, 2, 3], 3)
+        self.assertEqual([2, 4, 6], out)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -5,9 +5,32 @@ import numpy as np
 import abstract_rendering.numeric as numeric
 import abstract_rendering.util as util
 import abstract_rendering.core as core
+import abstract_rendering.infos as infos
+import abstract_rendering.glyphset as glyphset
 from abstract_rendering.glyphset import ShapeCodes
 
 
+def _glyphs(shapecode):
+    points = np.array([[0, 0, 1, 1],
+                       [2, 1, 3, 2],
+                       [2, 1, 3, 2],
+                       [1, 0, 3, 2],
+                       [-1, -1, 1, 1],
+                       [4, 1, 6, 5]], dtype=np.int32)
+    data = [1, 2, 3, 4, 5, 6]
+    return glyphset.Glyphset(points, data, glyphset.Literals(shapecode))
+
+
+def _per_glyph(op, glyphs, info, screen):
+    """Aggregate one glyph at a time (the non-vectorized path)."""
+    (width, height) = screen
+    existing = op.allocate(glyphs, screen)
+    for (points, data) in zip(glyphs.points(), glyphs.data()):
+        points = np.clip(points, 0, [width, height, width, height])
+        op.combine(existing, points, glyphs.shaper.code, info(data))
+    return existing
+
+
 class CountTests(unittest.TestCase):
     def test_allocate(self):
         op = numeric.Count()
@@ -59,6 +82,34 @@ class CountTests(unittest.TestCase):
         result = op.rollup(ones, ones)
         self.assertTrue(np.array_equal(result, twos))
 
+    def test_aggregate(self):
+        op = numeric.Count()
+        for code in [ShapeCodes.POINT, ShapeCodes.RECT]:
+            glyphs = _glyphs(code)
+            out = op.aggregate(glyphs, infos.val(), (5, 4))
+            expected = _per_glyph(op, glyphs, infos.val(), (5, 4))
+            self.assertEquals(out.dtype, op.out_type)
+            self.assertTrue(np.array_equal(out, expected),
+                            "Unequal:\n %s \n = \n %s" % (out, expected))
+
+    def test_aggregate_lines(self):
+        op = numeric.Count()
+        points = np.array([[0, 0, 4, 3], [1, 0, 2, 4], [0, 0, 5, 4]])
+        glyphs = glyphset.Glyphset(points, [1, 2, 3],
+                                   glyphset.Literals(ShapeCodes.LINE))
+        out = op.aggregate(glyphs, infos.val(), (5, 4))
+        expected = _per_glyph(op, glyphs, infos.val(), (5, 4))
+        self.assertTrue(np.array_equal(out, expected),
+                        "Unequal:\n %s \n = \n %s" % (out, expected))
+
+    def test_aggregate_rect_modes(self):
+        glyphs = _glyphs(ShapeCodes.RECT)
+        expected = numeric.Count(rects="fill").aggregate(glyphs, infos.val(), (5, 4))
+        for mode in ["summed", "auto"]:
+            out = numeric.Count(rects=mode).aggregate(glyphs, infos.val(), (5, 4))
+            self.assertEquals(out.dtype, expected.dtype)
+            self.assertTrue(np.array_equal(out, expected), mode)
+
 
 class SumTests(unittest.TestCase):
     def test_allocate(self):
@@ -110,6 +161,145 @@ class SumTests(unittest.TestCase):
         result = op.rollup(ones, ones)
         self.assertTrue(np.array_equal(result, twos))
 
+    def test_aggregate(self):
+        op = numeric.Sum()
+        for code in [ShapeCodes.POINT, ShapeCodes.RECT]:
+            glyphs = _glyphs(code)
+            out = op.aggregate(glyphs, infos.val(), (5, 4))
+            expected = _per_glyph(op, glyphs, infos.val(), (5, 4))
+            self.assertTrue(np.array_equal(out, expected),
+                            "Unequal:\n %s \n = \n %s" % (out, expected))
+
+    def test_aggregate_rect_modes(self):
+        glyphs = _glyphs(ShapeCodes.RECT)
+        expected = numeric.Sum(rects="fill").aggregate(glyphs, infos.val(), (5, 4))
+        out = numeric.Sum(rects="summed").aggregate(glyphs, infos.val(), (5, 4))
+        self.assertTrue(np.array_equal(out, expected))
+
+
+class UfuncAggregatorTests(unittest.TestCase):
+    def _check(self, op, codes=(ShapeCodes.POINT, ShapeCodes.RECT)):
+        for code in codes:
+            glyphs = _glyphs(code)
+            out = op.aggregate(glyphs, infos.val(), (5, 4))
+            expected = _per_glyph(op, glyphs, infos.val(), (5, 4))
+            self.assertTrue(np.array_equal(out, expected),
+                            "Unequal:\n %s \n = \n %s" % (out, expected))
+        return out
+
+    def test_max(self):
+        out = self._check(numeric.Max())
+        self.assertEqual(out[1, 2], 4)
+        self.assertEqual(out[3, 0], -np.inf)
+
+    def test_min(self):
+        out = self._check(numeric.Min())
+        self.assertEqual(out[1, 2], 2)
+        self.assertEqual(out[3, 0], np.inf)
+
+    def test_custom(self):
+        op = core.UfuncAggregator(np.bitwise_or, 0, np.int32)
+        out = self._check(op)
+        self.assertEqual(out.dtype, np.int32)
+        self.assertEqual(out[1, 2], 2 | 3 | 4)
+        self.assertRaises(ValueError, core.UfuncAggregator, np.add)
+
+    def test_lines(self):
+        glyphs = _glyphs(ShapeCodes.LINE)
+        out = numeric.Max().aggregate(glyphs, infos.val(), (5, 4))
+        count = numeric.Count().aggregate(glyphs, infos.val(), (5, 4))
+        self.assertTrue(np.array_equal(out > -np.inf, count > 0))
+        self.assertEqual(out.max(), 6)
+
+    def test_rollup(self):
+        op = numeric.Max()
+        parts = [np.array([[1., 5.]]), np.array([[3., 2.]]),
+                 np.array([[-np.inf, 6.]])]
+        result = op.rollup(*parts)
+        self.assertTrue(np.array_equal(result, [[3, 6]]))
+        self.assertTrue(np.array_equal(parts[0], [[1, 5]]))
+
+
+class CountDistinctTests(unittest.TestCase):
+    screen = (4, 3)
+
+    def _glyphs(self, n, values):
+        rng = np.random.RandomState(7)
+        points = np.zeros((n, 4), dtype=np.int32)
+        points[:, 0] = rng.randint(0, 4, n)
+        points[:, 1] = rng.randint(0, 3, n)
+        points[:, 2:] = points[:, :2] + 1
+        return glyphset.Glyphset(points, values,
+                                 glyphset.Literals(ShapeCodes.POINT))
+
+    def _distinct(self, glyphs):
+        points = glyphs.points()
+        (width, height) = self.screen
+        return np.array([[len(set(np.asarray(glyphs.data())[
+                              (points[:, 0] == x) & (points[:, 1] == y)]))
+                          for x in range(width)] for y in range(height)])
+
+    def test_estimate(self):
+        users = np.random.RandomState(8).randint(0, 3000, 40000)
+        glyphs = self._glyphs(len(users), users)
+        op = numeric.CountDistinct(precision=10)
+        registers = op.aggregate(glyphs, infos.val(), self.screen)
+        self.assertEqual(registers.shape, (3, 4, 1024))
+        self.assertEqual(registers.dtype, np.uint8)
+        estimate = numeric.EstimateDistinct()(registers)
+        error = np.abs(estimate / self._distinct(glyphs) - 1)
+        self.assertLess(error.max(), 0.1)
+
+    def test_small(self):
+        glyphs = self._glyphs(300, ["a", "b"] * 150)
+        registers = numeric.CountDistinct().aggregate(glyphs, infos.val(),
+                                                      self.screen)
+        estimate = numeric.EstimateDistinct()(registers)
+        self.assertTrue(np.allclose(estimate, self._distinct(glyphs),
+                                    atol=0.1))
+
+        empty = numeric.CountDistinct().allocate(glyphs, self.screen)
+        self.assertTrue(np.array_equal(numeric.EstimateDistinct()(empty),
+                                       np.zeros((3, 4))))
+
+    def test_blocks(self):
+        "Estimates summed by blocks of rows match the whole-grid formula"
+        rng = np.random.RandomState(4)
+        for shape in [(70, 5, 16), (3, 4, 64), (9, 2, 8)]:
+            m = shape[2]
+            registers = rng.randint(0, 12, shape).astype(np.uint8)
+            registers[rng.uniform(size=shape) < 0.3] = 0
+            alpha = {16: 0.673, 64: 0.709}.get(m, 0.7213/(1+1.079/m))
+            inverse = (2.0 ** -registers.astype(int)).sum(axis=2)
+            estimate = alpha * m * m / inverse
+            empty = (registers == 0).sum(axis=2)
+            linear = m * np.log(m / np.maximum(empty, 1.0))
+            expected = np.where((estimate <= 2.5 * m) & (empty > 0),
+                                linear, estimate)
+            self.assertTrue(np.allclose(numeric.EstimateDistinct()(registers),
+                                        expected), "%s" % (shape,))
+
+    def test_rollup(self):
+        users = np.random.RandomState(9).randint(0, 500, 3000)
+        op = numeric.CountDistinct()
+        whole = op.aggregate(self._glyphs(3000, users), infos.val(),
+                             self.screen)
+        parts = []
+        for (start, stop) in [(0, 1000), (1000, 2500), (2500, 3000)]:
+            part = self._glyphs(3000, users)
+            part = glyphset.Glyphset(part.points()[start:stop],
+                                     users[start:stop], part.shaper)
+            parts.append(op.aggregate(part, infos.val(), self.screen))
+        self.assertTrue(np.array_equal(op.rollup(*parts), whole))
+
+    def test_per_glyph(self):
+        op = numeric.CountDistinct()
+        for code in [ShapeCodes.POINT, ShapeCodes.RECT]:
+            glyphs = _glyphs(code)
+            out = op.aggregate(glyphs, infos.val(), (5, 4))
+            expected = _per_glyph(op, glyphs, infos.val(), (5, 4))
+            self.assertTrue(np.array_equal(out, expected))
+
 
 def _test_extend(op1, tester):
     op2 = numeric.Cuberoot()
@@ -2,9 +2,407 @@ from __future__ import print_function
 
 import unittest
 import numpy as np
+import abstract_rendering.fast_aggregate as fast_aggregate
+import abstract_rendering.glyphset as glyphset
+import abstract_rendering.infos as infos
 import abstract_rendering.numpyglyphs as npg
 
 
+class PointCountTests(unittest.TestCase):
+    screen = (23, 11)
+
+    def _expected(self, glyphs):
+        (width, height) = self.screen
+        projected = glyphs.points()
+        (x, y) = (np.floor(projected[:, 0]).astype(int),
+                  np.floor(projected[:, 1]).astype(int))
+        keep = (x >= 0) & (x < width) & (y >= 0) & (y < height)
+        expected = np.zeros((height, width))
+        np.add.at(expected, (y[keep], x[keep]), 1)
+        return expected
+
+    def test_aggregate(self):
+        rng = np.random.RandomState(1)
+        points = np.zeros((500, 4), order="F")
+        points[:, 0] = rng.uniform(-3, 15, 500)
+        points[:, 1] = rng.uniform(-3, 8, 500)
+        for dtype in [np.float64, np.float32]:
+            base = npg.Glyphset(points.astype(dtype, order="F"), None)
+            for vt in [(0, 0, 1, 1), (2.5, -1, 1.75, 1.5), (0, 0, -2, 3)]:
+                glyphs = base.project(vt)
+                out = npg.PointCount().aggregate(glyphs, None, self.screen)
+                self.assertTrue(np.array_equal(out, self._expected(glyphs)),
+                                "%s %s" % (dtype, vt))
+
+    def test_unprojected(self):
+        points = np.array([[.5, .5, 0, 0], [2.2, 1.5, 0, 0], [2.7, 1.1, 0, 0]])
+        glyphs = glyphset.Glyphset(points, None,
+                                   glyphset.Literals(glyphset.ShapeCodes.POINT))
+        out = npg.PointCount().aggregate(glyphs, None, (3, 2))
+        self.assertTrue(np.array_equal(out, [[1, 0, 0], [0, 0, 2]]))
+
+    def test_negative_fraction(self):
+        "Both paths agree on points in (-1, 0)"
+        points = np.array([[-.5, .5, 0, 0], [.5, .5, 0, 0], [.5, -.25, 0, 0]],
+                          order="F")
+        literal = glyphset.Glyphset(points, None,
+                                    glyphset.Literals(glyphset.ShapeCodes.POINT))
+        expected = [[1, 0], [0, 0]]
+        for glyphs in [npg.Glyphset(points, None), literal]:
+            out = npg.PointCount().aggregate(glyphs, None, (2, 2))
+            self.assertTrue(np.array_equal(out, expected), type(glyphs))
+
+        # Projection truncates toward zero, for either kind of glyphset
+        vt = (-.25, 0, 1, 1)
+        fused = npg.PointCount().aggregate(npg.Glyphset(points, None).project(vt),
+                                           None, (2, 2))
+        projected = npg.PointCount().aggregate(literal.project(vt), None, (2, 2))
+        self.assertTrue(np.array_equal(fused, projected))
+        self.assertTrue(np.array_equal(fused, [[3, 0], [0, 0]]))
+
+    def test_bincount(self):
+        rng = np.random.RandomState(4)
+        points = np.zeros((400, 4), dtype=np.int32, order="F")
+        points[:, 0] = rng.randint(-3, 27, 400)
+        points[:, 1] = rng.randint(-3, 13, 400)
+        glyphs = glyphset.Glyphset(points, None,
+                                   glyphset.Literals(glyphset.ShapeCodes.POINT))
+        expected = self._expected(glyphs)
+        for dtype in [np.float64, np.int32, np.uint16]:
+            out = npg.PointCount(dtype).aggregate(glyphs, None, self.screen)
+            self.assertEqual(out.dtype, dtype)
+            self.assertTrue(np.array_equal(out, expected), dtype)
+        out = npg.PointCount().aggregate(glyphs, None, self.screen)
+        self.assertEqual(out.dtype, np.int32)
+
+    def test_dtype(self):
+        (width, height) = self.screen
+        points = np.zeros((100, 4), order="F")
+        points[:, 0] = np.linspace(0, 10, 100)
+        points[:, 1] = np.linspace(0, 5, 100)
+        base = npg.Glyphset(points, None)
+        glyphs = base.project((0, 0, 2, 2), self.screen)
+        expected = self._expected(glyphs)
+
+        aggregator = npg.PointCount(np.int32, check_bounds=False)
+        reuse = np.ones((height, width), dtype=np.int32)
+        literal = glyphset.Glyphset(glyphs.points(), None,
+                                    glyphset.Literals(glyphset.ShapeCodes.POINT))
+        for target in [glyphs, literal]:
+            out = aggregator.aggregate(target, None, self.screen, out=reuse)
+            self.assertIs(out, reuse)
+            self.assertTrue(np.array_equal(out, expected))
+
+
+class PointCountCategoriesTests(unittest.TestCase):
+    screen = (23, 11)
+
+    def _glyphs(self, n=500):
+        rng = np.random.RandomState(5)
+        points = np.zeros((n, 4), dtype=np.int32, order="F")
+        points[:, 0] = rng.randint(-3, 27, n)
+        points[:, 1] = rng.randint(-3, 13, n)
+        codes = rng.randint(-1, 4, n)
+        glyphs = glyphset.Glyphset(points, codes,
+                                   glyphset.Literals(glyphset.ShapeCodes.POINT))
+        return (glyphs, points, codes)
+
+    def _expected(self, points, codes, cats):
+        (width, height) = self.screen
+        (x, y) = (points[:, 0], points[:, 1])
+        keep = ((x >= 0) & (x < width) & (y >= 0) & (y < height) &
+                (codes >= 0) & (codes < cats))
+        expected = np.zeros((height, width, cats))
+        np.add.at(expected, (y[keep], x[keep], codes[keep]), 1)
+        return expected
+
+    def test_aggregate(self):
+        (glyphs, points, codes) = self._glyphs()
+        out = npg.PointCountCategories().aggregate(glyphs, infos.val(),
+                                                   self.screen)
+        self.assertEqual((out.shape, out.dtype), ((11, 23, 4), np.int32))
+        self.assertTrue(np.array_equal(out, self._expected(points, codes, 4)))
+
+        aggregator = npg.PointCountCategories(dtype=np.float32)
+        reused = aggregator.aggregate(glyphs, infos.val(), self.screen)
+        self.assertEqual(reused.dtype, np.float32)
+        again = aggregator.aggregate(glyphs, infos.val(), self.screen,
+                                     out=reused)
+        self.assertIs(again, reused)
+        self.assertTrue(np.array_equal(again, out))
+
+    def test_options(self):
+        (glyphs, points, codes) = self._glyphs()
+        aggregator = npg.PointCountCategories(cats=3, dtype=np.int32)
+        out = aggregator.aggregate(glyphs, None, self.screen)
+        self.assertEqual(out.dtype, np.int32)
+        self.assertTrue(np.array_equal(out, self._expected(points, codes, 3)))
+
+        wide = npg.PointCountCategories(cats=6, dtype=np.int32)
+        wide = wide.aggregate(glyphs, None, self.screen)
+        total = aggregator.rollup(out, wide)
+        self.assertEqual((total.shape, total.dtype), ((11, 23, 6), np.int32))
+        self.assertTrue(np.array_equal(total[:, :, :3], out * 2))
+
+
+class PointMomentsTests(unittest.TestCase):
+    screen = (7, 5)
+
+    def _glyphs(self, n=600, seed=6):
+        rng = np.random.RandomState(seed)
+        points = np.zeros((n, 4), dtype=np.int32, order="F")
+        points[:, 0] = rng.randint(-1, 8, n)
+        points[:, 1] = rng.randint(-1, 6, n)
+        vals = rng.uniform(0, 100, n)
+        return glyphset.Glyphset(points, vals,
+                                 glyphset.Literals(glyphset.ShapeCodes.POINT))
+
+    def _cells(self, glyphs):
+        "Info values of each cell, by (row, column)"
+        (width, height) = self.screen
+        cells = {}
+        for ((x, y, _, _), v) in zip(glyphs.points(), glyphs.data()):
+            if 0 <= x < width and 0 <= y < height:
+                cells.setdefault((y, x), []).append(v)
+        return cells
+
+    def test_fallback(self):
+        self._without_kernels(self.test_shaders)
+
+    def test_shaders(self):
+        glyphs = self._glyphs()
+        moments = npg.PointMoments().aggregate(glyphs, infos.val(),
+                                               self.screen)
+        self.assertEqual(moments.shape, (5, 7, 3))
+        (mean, var, std) = (npg.Mean()(moments), npg.Variance(ddof=1)(moments),
+                            npg.Std()(moments))
+        cells = self._cells(glyphs)
+        for y in range(5):
+            for x in range(7):
+                vals = cells.get((y, x), [])
+                self.assertEqual(moments[y, x, 0], len(vals))
+                if len(vals) == 0:
+                    self.assertTrue(np.isnan(mean[y, x]))
+                    continue
+                self.assertAlmostEqual(mean[y, x], np.mean(vals))
+                self.assertAlmostEqual(std[y, x], np.std(vals))
+                if len(vals) > 1:
+                    self.assertAlmostEqual(var[y, x], np.var(vals, ddof=1),
+                                           places=6)
+                else:
+                    self.assertTrue(np.isnan(var[y, x]))
+
+    def _without_kernels(self, check):
+        "Run check with the numpy fallback in place of the native kernel"
+        import abstract_rendering.fast_aggregate as fast_aggregate
+        scatter_moments = fast_aggregate.scatter_moments
+        fast_aggregate.scatter_moments = lambda *args: False
+        try:
+            check()
+        finally:
+            fast_aggregate.scatter_moments = scatter_moments
+
+    def test_offset(self):
+        "Values far from zero keep their variance"
+        rng = np.random.RandomState(10)
+        vals = 1.7e9 + rng.normal(0, np.sqrt(8.44), 1000)
+        points = np.zeros((1000, 4), dtype=np.int32, order="F")
+        points[500:, 0] = 1
+        glyphs = glyphset.Glyphset(points, vals,
+                                   glyphset.Literals(glyphset.ShapeCodes.POINT))
+        aggregator = npg.PointMoments()
+
+        def check():
+            moments = aggregator.aggregate(glyphs, infos.val(), (2, 1))
+            variance = npg.Variance()(moments)
+            self.assertTrue(np.allclose(variance[0], [np.var(vals[:500]),
+                                                      np.var(vals[500:])]))
+            halves = [glyphset.Glyphset(points[part], vals[part], glyphs.shaper)
+                      for part in [slice(0, 700), slice(700, 1000)]]
+            total = aggregator.rollup(*[aggregator.aggregate(h, infos.val(),
+                                                             (2, 1))
+                                        for h in halves])
+            self.assertTrue(np.allclose(npg.Variance()(total), variance))
+            self.assertTrue(np.allclose(npg.Mean()(total),
+                                        [vals[:500].mean(), vals[500:].mean()],
+                                        rtol=1e-14, atol=0))
+        check()
+        self._without_kernels(check)
+
+    def test_rollup(self):
+        aggregator = npg.PointMoments()
+        parts = [self._glyphs(200, seed) for seed in range(3)]
+        whole = glyphset.Glyphset(
+            np.vstack([p.points() for p in parts]).copy(order="F"),
+            np.hstack([p.data() for p in parts]),
+            glyphset.Literals(glyphset.ShapeCodes.POINT))
+        expected = aggregator.aggregate(whole, infos.val(), self.screen)
+        total = aggregator.rollup(*[aggregator.aggregate(p, infos.val(),
+                                                         self.screen)
+                                    for p in parts])
+        self.assertTrue(np.allclose(total, expected))
+
+
+class ProjectionCacheTests(unittest.TestCase):
+    vts = [(1, 2, 2.5, 2), (-3, 0, 1.5, 1.5), (1, 2, 2.5, 2)]
+
+    def _points(self, n=300):
+        rng = np.random.RandomState(2)
+        points = np.zeros((n, 4), order="F")
+        points[:, 0] = rng.uniform(-2, 10, n)
+        points[:, 1] = rng.uniform(-2, 6, n)
+        return (points, rng.randint(0, 3, n))
+
+    def test_hits(self):
+        (points, data) = self._points()
+        glyphs = npg.Glyphset(points, data).cacheProjections()
+        plain = npg.Glyphset(points, data)
+        for screen in [None, (23, 11)]:
+            for vt in self.vts:
+                out = glyphs.project(vt, screen)
+                expected = plain.project(vt, screen)
+                self.assertTrue(np.array_equal(out.points(),
+                                               expected.points()))
+                self.assertTrue(np.array_equal(out.data(), expected.data()))
+                self.assertEqual(out.culled, expected.culled)
+                self.assertEqual(out.vt, expected.vt)
+                self.assertIs(out.buffer, None)
+        self.assertEqual((glyphs.cache.hits, glyphs.cache.misses), (2, 4))
+        self.assertIs(glyphs.project(self.vts[0]).points(),
+                      glyphs.project(self.vts[0]).points())
+
+    def test_budget(self):
+        (points, data) = self._points()
+        projection = points.size * 4  # int32 coordinates
+        glyphs = npg.Glyphset(points, data).cacheProjections(projection * 2)
+        for vt in self.vts[:2] + [(0, 0, 3, 3)]:
+            glyphs.project(vt)
+        self.assertEqual(len(glyphs.cache), 2)
+        self.assertTrue(glyphs.cache.used <= projection * 2)
+        glyphs.project(self.vts[0])  # Evicted as least recently used
+        self.assertEqual(glyphs.cache.hits, 0)
+
+
+class LazyProjectionTests(unittest.TestCase):
+    def _points(self, n=300, dtype=np.float64):
+        rng = np.random.RandomState(3)
+        points = np.zeros((n, 4), order="F", dtype=dtype)
+        points[:, 0] = rng.uniform(-2, 10, n)
+        points[:, 1] = rng.uniform(-2, 6, n)
+        return (points, rng.randint(0, 3, n))
+
+    def test_chained(self):
+        (points, data) = self._points()
+        glyphs = npg.Glyphset(points, data).project((1, 2, 2, 2))
+        glyphs = glyphs.project((-3, 1, 1.5, 1))
+        self.assertIs(glyphs._projected, None)
+        self.assertEqual(glyphs.vt, (-2, 3, 3, 2))
+        self.assertIs(glyphs.data(), data)
+        self.assertIs(glyphs._projected, None)
+
+        expected = npg.Glyphset(points, data, (-2, 3, 3, 2))
+        self.assertTrue(np.array_equal(glyphs.points(), expected.points()))
+
+    def test_bounds(self):
+        for dtype in [np.float64, np.float32]:
+            (points, data) = self._points(dtype=dtype)
+            for vt in [(1, 2, 2.5, 2), (0.5, -1, -1.5, 3)]:
+                glyphs = npg.Glyphset(points, data, vt)
+                bounds = glyphs.bounds()
+                self.assertIs(glyphs._projected, None)
+                glyphs.points()
+                self.assertEqual(bounds, glyphs.bounds(),
+                                 "%s %s" % (dtype, vt))
+
+    def test_columns(self):
+        (points, data) = self._points()
+        columns = glyphset.Columns(points[:, 0], points[:, 1])
+        glyphs = npg.Glyphset(columns, data, (1, 2, 2, 2))
+        expected = npg.Glyphset(points, data, (1, 2, 2, 2))
+        self.assertTrue(np.array_equal(glyphs.points(), expected.points()))
+        self.assertEqual(glyphs.bounds(), expected.bounds())
+
+    def test_reproject_culled(self):
+        (points, data) = self._points()
+        for base in [npg.Glyphset(points, data),
+                     npg.Glyphset(points, data).buildIndex(bins=4)]:
+            first = base.project((1, 2, 2, 2), (8, 6))
+            self.assertLess(len(first.points()), len(points))
+            again = first.project((-10, -4, 1, 1))
+            expected = npg.Glyphset(points, data, (-9, -2, 2, 2))
+            self.assertEqual(len(again.points()), len(points))
+            self.assertTrue(np.array_equal(again.points(), expected.points()))
+            self.assertTrue(np.array_equal(again.data(), data))
+
+    def test_screen(self):
+        (points, data) = self._points()
+        glyphs = npg.Glyphset(points, data).project((1, 2, 2, 2), (15, 9))
+        self.assertIs(glyphs._projected, None)
+        out = npg.PointCount().aggregate(glyphs, None, (15, 9))
+        if fast_aggregate._lib is not None:
+            # Projected and counted in one pass, without projecting
+            self.assertIs(glyphs._projected, None)
+
+        self.assertEqual(len(glyphs.data()), len(glyphs.points()))
+        self.assertEqual(glyphs.culled, len(points) - len(glyphs.data()))
+        self.assertEqual(out.sum(), len(glyphs.points()))
+
+    def test_screen_fallback(self):
+        "Without the native kernels, counting projects (and keeps it)"
+        (points, data) = self._points()
+        lib = fast_aggregate._lib
+        fast_aggregate._lib = None
+        try:
+            glyphs = npg.Glyphset(points, data).project((1, 2, 2, 2), (15, 9))
+            out = npg.PointCount().aggregate(glyphs, None, (15, 9))
+            self.assertIsNot(glyphs._projected, None)
+        finally:
+            fast_aggregate._lib = lib
+        expected = npg.Glyphset(points, data).project((1, 2, 2, 2), (15, 9))
+        self.assertTrue(np.array_equal(out, npg.PointCount().aggregate(
+            expected, None, (15, 9))))
+        self.assertEqual(out.sum(), len(glyphs.points()))
+
+
+class Float32Tests(unittest.TestCase):
+    def test_load_csv(self):
+        import os
+        import tempfile
+        (fd, path) = tempfile.mkstemp(suffix=".csv")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write("x,y,v\n1.5,2.25,3\n4,5.5,6\n")
+            glyphs = npg.load_csv(path, 1, 0, 1, 2, dtype=np.float32)
+        finally:
+            os.remove(path)
+        self.assertEquals(glyphs._points.dtype, np.float32)
+        self.assertTrue(np.array_equal(glyphs._points,
+                                       [[1.5, 2.25, 0, 0], [4, 5.5, 0, 0]]))
+        self.assertTrue(np.array_equal(glyphs.data(), [3, 6]))
+
+    def test_pipeline(self):
+        rng = np.random.RandomState(4)
+        points = np.zeros((1000, 4), order="F")
+        points[:, 0] = rng.uniform(0, 100, 1000)
+        points[:, 1] = rng.uniform(0, 50, 1000)
+        vt = (-10, -5, 2.5, 2.5)
+        screen = (200, 100)
+
+        full = npg.Glyphset(points, None).buildIndex()
+        half = npg.Glyphset(points.astype(np.float32, order="F"),
+                            None).buildIndex()
+        self.assertEquals(half.spatial.points.dtype, np.float32)
+        self.assertEquals(half.project(vt)._points.dtype, np.float32)
+
+        expected = npg.PointCount().aggregate(full.project(vt, screen),
+                                              None, screen)
+        out = npg.PointCount().aggregate(half.project(vt, screen),
+                                         None, screen)
+        # Only points within the envelope of a pixel edge may move
+        self.assertEquals(out.sum(), expected.sum())
+        self.assertLessEqual(np.abs(out - expected).sum(), 4)
+
+
 class SpreadTests(unittest.TestCase):
     def run_spread(self, spread, in_vals, expected, **kwargs):
         op = npg.Spread(factor=spread, **kwargs)
@@ -56,6 +56,36 @@ class ColorTest(unittest.TestCase):
         self.assertRaises(ValueError, util.Color, 0, 0, 0, -1)
 
 
+class LRUCacheTests(unittest.TestCase):
+    def test_evict(self):
+        cache = util.LRUCache(10)
+        cache.put("a", 1, 4)
+        cache.put("b", 2, 4)
+        self.assertEqual(cache.get("a"), 1)
+        cache.put("c", 3, 4)  # Evicts b, the least recently used
+        self.assertFalse("b" in cache)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+        self.assertEqual(cache.used, 8)
+        self.assertEqual((cache.hits, cache.misses), (3, 0))
+
+    def test_oversized(self):
+        cache = util.LRUCache(10)
+        cache.put("a", 1, 4)
+        cache.put("b", 2, 11)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.get("b", "missing"), "missing")
+
+    def test_replace(self):
+        cache = util.LRUCache(10)
+        cache.put("a", 1, 4)
+        cache.put("a", 2, 6)
+        self.assertEqual(cache.get("a"), 2)
+        self.assertEqual(cache.used, 6)
+        cache.discard("a")
+        self.assertEqual((len(cache), cache.used), (0, 0))
+
+
 class ZoomFitTest(unittest.TestCase):
     def test_scale(self):
         self.assertEqual(util.zoom_fit((10, 10), (0, 0, 10, 10)),
@@ -0,0 +1,305 @@
+/*
+  Multithreaded version of transform.cpp, for platforms without
+  libdispatch (see transform_libdispatch.cpp).  It provides the same
+  entry points: transform_f/transform_d split the work over a set of
+  std::threads, and the async_transform_* functions project chunks on a
+  background thread while the caller consumes the previous chunk.
+
+  This has been tested on linux using the following compile line:
+  g++ -O3 -std=c++11 -pthread -fPIC -shared transform_threads.cpp -o transform_threads.so
+
+ */
+
+#include <stddef.h>
+#include <stdint.h>
+#include <stdlib.h>
+#include <algorithm>
+#include <thread>
+#include <vector>
+
+#define RESTRICT __restrict__
+
+// Below this many glyphs per thread, extra threads cost more than they save
+#define MIN_PER_THREAD (1<<15)
+
+namespace {
+    template <typename IT>
+    inline void
+    transf_single(IT tx, IT ty, IT sx, IT sy,
+                  IT x, IT y, IT w, IT h,
+                  int32_t& x0, int32_t& y0, int32_t& x1, int32_t& y1)
+    {
+        x0 = x*sx + tx;
+        y0 = y*sy + ty;
+        x1 = (x + w)*sx + tx;
+        y1 = (y + h)*sy + ty;
+    }
+
+    ////////////////////////////////////////////////////////////////////////
+
+    template <typename IT>
+    struct transform_params_t
+    {
+        IT xtr[4];
+        IT const *in[4];
+        int32_t * RESTRICT out[4];
+        size_t in_offset;
+        size_t count;
+    };
+
+    // Project glyphs [start, stop) of the parameter block
+    template <typename IT>
+    void
+    transform_range(const transform_params_t<IT>* arg,
+                    size_t start,
+                    size_t stop)
+    {
+        const IT tx = arg->xtr[0];
+        const IT ty = arg->xtr[1];
+        const IT sx = arg->xtr[2];
+        const IT sy = arg->xtr[3];
+
+        IT const *x = arg->in[0] + arg->in_offset;
+        IT const *y = arg->in[1] + arg->in_offset;
+        IT const *w = arg->in[2] + arg->in_offset;
+        IT const *h = arg->in[3] + arg->in_offset;
+
+        int32_t * RESTRICT x0 = arg->out[0];
+        int32_t * RESTRICT y0 = arg->out[1];
+        int32_t * RESTRICT x1 = arg->out[2];
+        int32_t * RESTRICT y1 = arg->out[3];
+
+        for (size_t i = start; i < stop; i++)
+        {
+            transf_single(tx, ty, sx, sy,
+                          x[i], y[i], w[i], h[i],
+                          x0[i], y0[i], x1[i], y1[i]);
+        }
+    }
+
+    inline size_t
+    thread_count(size_t count)
+    {
+        // hardware_concurrency can cost microseconds, ask once
+        static const size_t hw = std::max(1u, std::thread::hardware_concurrency());
+        return std::max((size_t) 1, std::min(hw, count / MIN_PER_THREAD));
+    }
+
+    // Project all glyphs of the parameter block, using every core.
+    // The calling thread takes the first share of the work.
+    template <typename IT>
+    void
+    transform_parallel(const transform_params_t<IT>* arg)
+    {
+        size_t count = arg->count;
+        size_t threads = thread_count(count);
+        size_t share = (count + threads - 1) / threads;
+
+        std::vector<std::thread> workers;
+        for (size_t t = 1; t < threads; t++) {
+            size_t start = std::min(count, t * share);
+            size_t stop = std::min(count, start + share);
+            workers.push_back(std::thread(transform_range<IT>,
+                                          arg, start, stop));
+        }
+        transform_range(arg, 0, std::min(count, share));
+
+        for (size_t t = 0; t < workers.size(); t++) {
+            workers[t].join();
+        }
+    }
+
+    template <typename IT>
+    void
+    transform_entry(IT* xtr,
+                    IT** in,
+                    int32_t** RESTRICT out,
+                    size_t offset,
+                    size_t count)
+    {
+        transform_params_t<IT> params;
+
+        for (size_t i=0; i<4; i++)
+        {
+            params.xtr[i] = xtr[i];
+            params.in[i] = in[i];
+            params.out[i] = out[i];
+        }
+        params.in_offset = offset;
+        params.count = count;
+
+        transform_parallel(&params);
+    }
+
+    ////////////////////////////////////////////////////////////////////////
+
+    // Double-buffered chunk pipeline: while the caller reads one chunk,
+    // the next one is projected on a background thread.
+    template <typename IT>
+    struct async_context_t
+    {
+        transform_params_t<IT> tp;
+        int32_t* buffer;
+        std::thread worker;
+        size_t chunk_size;
+        size_t current_chunk;
+        size_t total_size;
+
+        async_context_t();
+        ~async_context_t();
+        bool init(IT* _xtr, IT** _in, size_t _count, size_t _cs);
+        void next(void** buff, size_t* current_count);
+    };
+
+    template <typename IT>
+    async_context_t<IT>::async_context_t():
+        buffer(NULL)
+    {
+    }
+
+    template <typename IT>
+    async_context_t<IT>::~async_context_t()
+    {
+        if (worker.joinable()) {
+            worker.join();
+        }
+        free(buffer);
+    }
+
+    template <typename IT>
+    void
+    async_context_t<IT>::next(void** return_buff, size_t* count)
+    {
+        *return_buff = NULL;
+        *count = 0;
+
+        if (worker.joinable()) {
+            worker.join();
+            size_t done_chunk = current_chunk - 1;
+            *return_buff = buffer + 4 * chunk_size * (done_chunk & 1);
+            *count = std::min(chunk_size,
+                              total_size - done_chunk * chunk_size);
+        }
+
+        // if not all the chunks have been processed, start a new task
+        size_t curr_offset = current_chunk * chunk_size;
+        if (curr_offset < total_size) {
+            int32_t* out = buffer + 4 * chunk_size * (current_chunk & 1);
+            for (size_t i=0; i<4; i++) {
+                tp.out[i] = out + chunk_size * i;
+            }
+            tp.in_offset = curr_offset;
+            tp.count = std::min(chunk_size, total_size - curr_offset);
+            worker = std::thread(transform_parallel<IT>, &tp);
+            current_chunk++;
+        }
+    }
+
+    template <typename IT>
+    bool
+    async_context_t<IT>::init(IT *_xtr, IT** _in,
+                              size_t _total, size_t _cs)
+    {
+        buffer = (int32_t*) malloc(4 * 2 * _cs * sizeof(int32_t));
+
+        if (!buffer)
+            return false;
+
+        chunk_size = _cs;
+        current_chunk = 0;
+        total_size = _total;
+
+        for (size_t i=0; i<4; i++) {
+            tp.xtr[i] = _xtr[i];
+            tp.in[i] = _in[i];
+        }
+
+        void *dummy;
+        size_t dummy2;
+        next(&dummy, &dummy2);
+
+        return true;
+    }
+
+    template <typename IT>
+    void *
+    async_start(IT* xtr, IT** in, size_t total, size_t chunk_size)
+    {
+        async_context_t<IT>* rv = new async_context_t<IT>();
+
+        if (! rv->init(xtr, in, total, chunk_size)) {
+            delete(rv);
+            rv = NULL;
+        }
+
+        return rv;
+    }
+} // namespace
+
+extern "C" void
+transform_f(float* xtr,
+            float** in,
+            int32_t** RESTRICT out,
+            size_t offset,
+            size_t count)
+{
+    transform_entry<float>(xtr, in, out, offset, count);
+}
+
+extern "C" void
+transform_d(double* xtr,
+            double** in,
+            int32_t** RESTRICT out,
+            size_t offset,
+            size_t count)
+{
+    transform_entry<double>(xtr, in, out, offset, count);
+}
+
+extern "C"
+void *
+async_transform_f_start(float* xtr,
+                        float** in,
+                        size_t total,
+                        size_t chunk_size)
+{
+    return async_start<float>(xtr, in, total, chunk_size);
+}
+
+extern "C"
+void
+async_transform_f_end(void *arg)
+{
+    delete((async_context_t<float>*) arg);
+}
+
+extern "C"
+void
+async_transform_f_next(void *arg, void** buff_out, size_t* count_out)
+{
+    ((async_context_t<float>*) arg)->next(buff_out, count_out);
+}
+
+extern "C"
+void *
+async_transform_d_start(double* xtr,
+                        double** in,
+                        size_t total,
+                        size_t chunk_size)
+{
+    return async_start<double>(xtr, in, total, chunk_size);
+}
+
+extern "C"
+void
+async_transform_d_end(void *arg)
+{
+    delete((async_context_t<double>*) arg);
+}
+
+extern "C"
+void
+async_transform_d_next(void *arg, void** buff_out, size_t* count_out)
+{
+    ((async_context_t<double>*) arg)->next(buff_out, count_out);
+}
@@ -1,4 +1,5 @@
 from __future__ import print_function, division, absolute_import
+from collections import OrderedDict
 
 
 class EmptyList(object):
@@ -27,6 +28,62 @@ class EmptyList(object):
         return None
 
 
+class LRUCache(object):
+    """
+    Mapping that holds values up to a memory budget, evicting the least
+    recently used entries to make room for new ones.
+
+    The size of each value is given when it is stored (e.g. the nbytes
+    of its arrays).  Values larger than the whole budget are not kept.
+
+    * budget -- Total size of the values to hold, in bytes
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        "Value for the key (marking it as just used), or default."
+        if key not in self._entries:
+            self.misses += 1
+            return default
+        self.hits += 1
+        entry = self._entries.pop(key)
+        self._entries[key] = entry
+        return entry[0]
+
+    def put(self, key, value, size):
+        "Store value under key, evicting old entries as needed."
+        self.discard(key)
+        if size > self.budget:
+            return
+        while self.used + size > self.budget:
+            (_, (_, old_size)) = self._entries.popitem(last=False)
+            self.used -= old_size
+        self._entries[key] = (value, size)
+        self.used += size
+
+    def discard(self, key):
+        "Remove the entry for key, if there is one."
+        if key in self._entries:
+            (_, size) = self._entries.pop(key)
+            self.used -= size
+
+    def clear(self):
+        self._entries.clear()
+        self.used = 0
+
+
 class Color(list):
     def __init__(self, r, g, b, a):
         list.__init__(self, [r, g, b, a])
@@ -35,6 +35,15 @@ else:
             extra_compile_args=['-O3', '-Wall', '-fno-rtti', '-fno-exceptions', '-fPIC', '-lstdc++'])
 
 
+# Multithreaded projection (std::thread); libdispatch covers OS X instead
+extensions = [transform]
+if sys.platform.startswith('linux'):
+    extensions.append(Extension('abstract_rendering.transform_threads',
+            ['abstract_rendering/transform_threads.cpp'],
+            extra_compile_args=['-O3', '-Wall', '-std=c++11', '-pthread', '-fno-rtti', '-fno-exceptions', '-fPIC'],
+            extra_link_args=['-pthread']))
+
+
 def getsitepackages():
     """Returns a list containing all global site-packages directories
     (and possibly site-python)."""
@@ -145,8 +154,10 @@ setup(name='abstract_rendering',
       packages=['abstract_rendering', 'abstract_rendering.test'],
       package_dir={'abstract_rendering': 'abstract_rendering'},
       package_data={'abstract_rendering': ['*.txt', '*.so', '*.dll']},
-      ext_modules=[
-          transform,
+      ext_modules=extensions + [
+          Extension('abstract_rendering.accumulate',
+              ['abstract_rendering/accumulate.cpp'],
+              extra_compile_args=['-O3', '-Wall', '-fno-rtti', '-fno-exceptions', '-fPIC', '-lstdc++']),
           Extension('abstract_rendering._cntr',
               ['abstract_rendering/cntr.c'],
               include_dirs=[numpy_include_dir],